@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tools.artifactstore import ArtifactStore
+from tools.buildcache import BuildCache
+
+####################################################################################################
+### Section Build Cache Tests
+####################################################################################################
+
+class BuildCacheTest(unittest.TestCase):
+
+    FINGERPRINT = 'f' * 64
+
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp(prefix='test-buildcache-')
+        self.prefix = os.path.join(self.workdir, 'openresty')
+        os.makedirs(os.path.join(self.prefix, 'nginx', 'sbin'))
+        os.makedirs(os.path.join(self.prefix, 'bin'))
+        with open(os.path.join(self.prefix, 'nginx', 'sbin', 'nginx'), 'wb') as ofile:
+            ofile.write(b'nginx')
+        os.symlink(os.path.join(self.prefix, 'nginx', 'sbin', 'nginx'), os.path.join(self.prefix, 'bin', 'openresty'))
+        self.cache = BuildCache(ArtifactStore(os.path.join(self.workdir, 'store')), self.prefix)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_restore_absolute_link_inside_prefix(self) -> None:
+        self.assertIsNotNone(self.cache.save(BuildCacheTest.FINGERPRINT))
+        shutil.rmtree(self.prefix)
+        self.assertTrue(self.cache.restore(BuildCacheTest.FINGERPRINT))
+        link = os.path.join(self.prefix, 'bin', 'openresty')
+        self.assertEqual(os.readlink(link), os.path.join('..', 'nginx', 'sbin', 'nginx'))
+        with open(link, 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'nginx')
+
+    def test_link_outside_prefix_is_rejected(self) -> None:
+        os.symlink('/etc/passwd', os.path.join(self.prefix, 'bin', 'passwd'))
+        self.assertIsNotNone(self.cache.save(BuildCacheTest.FINGERPRINT))
+        shutil.rmtree(self.prefix)
+        self.assertFalse(self.cache.restore(BuildCacheTest.FINGERPRINT))
+        self.assertFalse(os.path.lexists(os.path.join(self.prefix, 'bin', 'passwd')))
+
+    def test_restore_through_sudo(self) -> None:
+        self.assertIsNotNone(self.cache.save(BuildCacheTest.FINGERPRINT))
+        commands = []
+        with mock.patch('subprocess.run', side_effect=lambda command: commands.append(command) or mock.Mock(returncode=0)):
+            self.assertTrue(self.cache.restore(BuildCacheTest.FINGERPRINT, sudo=True))
+        self.assertEqual([command[:2] for command in commands], [['sudo', 'mkdir'], ['sudo', 'tar']])
+        self.assertEqual(commands[1][-2:], ['-C', self.prefix])
+
+
+if __name__ == '__main__':
+    unittest.main()
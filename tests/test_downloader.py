@@ -0,0 +1,216 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from unittest import mock
+
+from tools.sourcekits import Downloader
+
+####################################################################################################
+### Section Stand-in Server
+####################################################################################################
+
+class StandInServer(object):
+
+    def __init__(self, payload: bytes, etag: str = '"v1"') -> None:
+        self.payload = payload
+        self.etag = etag
+        self.drop_after: Optional[int] = None
+        self.drops = 0
+        self.throttle = 0.0
+        self.ranges = True
+        self.requests: List[Dict[str, Optional[str]]] = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                with server.lock:
+                    server.requests.append({'Range': self.headers.get('Range'), 'If-Range': self.headers.get('If-Range')})
+                    drop = server.drop_after if server.drops > 0 else None
+                    if drop is not None:
+                        server.drops -= 1
+                start, end = 0, len(server.payload) - 1
+                partial = False
+                requested = self.headers.get('Range')
+                if_range = self.headers.get('If-Range')
+                if server.ranges and requested and (if_range is None or if_range == server.etag):
+                    first, _, last = requested[len('bytes='):].partition('-')
+                    start = int(first)
+                    end = int(last) if last else end
+                    if start >= len(server.payload):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(server.payload)}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    partial = True
+                body = server.payload[start:end + 1]
+                self.send_response(206 if partial else 200)
+                self.send_header('ETag', server.etag)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(len(body)))
+                if partial:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(server.payload)}')
+                self.end_headers()
+                if drop is not None:
+                    body = body[:drop]
+                for i in range(0, len(body), 16 * 1024):
+                    self.wfile.write(body[i:i + 16 * 1024])
+                    if server.throttle:
+                        time.sleep(server.throttle)
+                if drop is not None:
+                    self.wfile.flush()
+                    self.close_connection = True
+                    self.connection.shutdown(2)
+
+        class Server(ThreadingHTTPServer):
+
+            daemon_threads = True
+
+            def handle_error(self, request, client_address) -> None:
+                pass
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/payload.bin'
+
+    def __enter__(self) -> 'StandInServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+####################################################################################################
+### Section Downloader Tests
+####################################################################################################
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp(prefix='test-downloader-')
+        self.payload = os.urandom(3 * 256 * 1024 + 123)
+        patches = [
+            mock.patch.object(Downloader, 'RETRY_DELAY', 0),
+            mock.patch.object(Downloader, 'SEGMENT_MIN_SIZE', 64 * 1024),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self, filepath: str) -> bytes:
+        with open(filepath, 'rb') as ifile:
+            return ifile.read()
+
+    def assert_clean(self, filepath: str) -> None:
+        self.assertFalse(os.path.exists(filepath + Downloader.PART_SUFFIX))
+        self.assertFalse(os.path.exists(filepath + Downloader.PART_META_SUFFIX))
+
+    def test_plain_download(self) -> None:
+        with StandInServer(self.payload) as server:
+            filepath = Downloader(self.root).download(server.url, 'payload.bin')
+        self.assertEqual(self.read(filepath), self.payload)
+        self.assert_clean(filepath)
+
+    def test_resume_after_drops(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.drop_after = 200 * 1024
+            server.drops = 2
+            filepath = Downloader(self.root, retries=1).download(server.url, 'payload.bin')
+        self.assertEqual(self.read(filepath), self.payload)
+        self.assert_clean(filepath)
+        self.assertEqual(len(server.requests), 3)
+        self.assertIsNone(server.requests[0]['Range'])
+        self.assertEqual(server.requests[1]['Range'], f'bytes={200 * 1024}-')
+        self.assertEqual(server.requests[1]['If-Range'], '"v1"')
+        self.assertEqual(server.requests[2]['Range'], f'bytes={400 * 1024}-')
+
+    def test_resume_across_runs(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.drop_after = 100 * 1024
+            server.drops = 1
+            self.assertIsNone(Downloader(self.root, retries=0).download(server.url, 'payload.bin'))
+            filepath = os.path.join(self.root, 'payload.bin')
+            self.assertEqual(os.path.getsize(filepath + Downloader.PART_SUFFIX), 100 * 1024)
+            self.assertEqual(Downloader(self.root).download(server.url, 'payload.bin'), filepath)
+        self.assertEqual(self.read(filepath), self.payload)
+        self.assertEqual(server.requests[-1]['Range'], f'bytes={100 * 1024}-')
+
+    def test_if_range_mismatch_restarts(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.drop_after = 100 * 1024
+            server.drops = 1
+            self.assertIsNone(Downloader(self.root, retries=0).download(server.url, 'payload.bin'))
+            server.payload = self.payload[::-1]
+            server.etag = '"v2"'
+            filepath = Downloader(self.root).download(server.url, 'payload.bin')
+        self.assertEqual(self.read(filepath), self.payload[::-1])
+        self.assertEqual(server.requests[-1]['If-Range'], '"v1"')
+
+    def test_segmented_download_with_drops_and_throttling(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.throttle = 0.001
+            server.drop_after = 50 * 1024
+            server.drops = 3
+            filepath = Downloader(self.root, segments=4, retries=2).download(server.url, 'payload.bin')
+        self.assertEqual(self.read(filepath), self.payload)
+        self.assert_clean(filepath)
+        self.assertEqual(server.requests[0]['Range'], 'bytes=0-')
+        ranged = [request['Range'] for request in server.requests[1:]]
+        self.assertTrue(all(value and value != 'bytes=0-' for value in ranged))
+        size = -(-len(self.payload) // 4)
+        offsets = [int(value[len('bytes='):].partition('-')[0]) % size for value in ranged]
+        self.assertEqual(offsets.count(0), 4)
+        self.assertTrue(offsets.count(50 * 1024) >= 1)
+        self.assertEqual(set(offsets), {0, 50 * 1024})
+
+    def test_segmented_falls_back_without_ranges(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.ranges = False
+            filepath = Downloader(self.root, segments=4).download(server.url, 'payload.bin')
+        self.assertEqual(self.read(filepath), self.payload)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_expected_digest(self) -> None:
+        digest = hashlib.sha256(self.payload).hexdigest()
+        with StandInServer(self.payload) as server:
+            server.drop_after = 300 * 1024
+            server.drops = 1
+            filepath = Downloader(self.root).download(server.url, 'payload.bin', expected=('sha256', digest))
+            self.assertEqual(self.read(filepath), self.payload)
+            os.remove(filepath)
+            self.assertIsNone(Downloader(self.root).download(server.url, 'payload.bin', expected=('sha256', '0' * 64)))
+        self.assert_clean(filepath)
+        self.assertFalse(os.path.exists(filepath))
+
+    def test_gives_up_without_progress(self) -> None:
+        with StandInServer(self.payload) as server:
+            server.drop_after = 0
+            server.drops = 10
+            self.assertIsNone(Downloader(self.root, retries=2).download(server.url, 'payload.bin'))
+        self.assertEqual(len(server.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
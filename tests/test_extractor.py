@@ -0,0 +1,98 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from tools.sourcekits import Extractor, ParallelTarExtractor, TarExtractor
+
+####################################################################################################
+### Section Archives
+####################################################################################################
+
+def add_symlink(tar: tarfile.TarFile, name: str, linkname: str) -> None:
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.SYMTYPE
+    info.linkname = linkname
+    tar.addfile(info)
+
+def add_file(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+def symlink_chain_archive(target: str) -> None:
+    with tarfile.open(target, 'w:gz') as tar:
+        add_symlink(tar, 'a/b', '..')
+        add_symlink(tar, 'a/b/c', '..')
+        add_file(tar, 'a/b/c/evil', b'evil')
+
+def plain_archive(target: str) -> None:
+    with tarfile.open(target, 'w:gz') as tar:
+        add_file(tar, 'pkg/src/main.c', b'int main() { return 0; }\n')
+        add_symlink(tar, 'pkg/link.c', 'src/main.c')
+        add_file(tar, 'pkg/README', b'readme')
+
+
+####################################################################################################
+### Section Extractor Tests
+####################################################################################################
+
+class ExtractorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp(prefix='test-extractor-')
+        self.root = os.path.join(self.workdir, 'root')
+        os.makedirs(self.root)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def escaped(self) -> bool:
+        return any(os.path.lexists(os.path.join(folder, 'evil')) for folder in (self.workdir, self.root))
+
+    def extractors(self):
+        yield 'tar', TarExtractor(self.root, 'gz')
+        yield 'parallel', ParallelTarExtractor(self.root, 'gz', workers=2)
+
+    def test_symlink_chain_is_rejected(self) -> None:
+        archive = os.path.join(self.workdir, 'chain.tar.gz')
+        symlink_chain_archive(archive)
+        for name, extractor in self.extractors():
+            with self.subTest(extractor=name):
+                self.assertIsNone(extractor.extract(archive))
+                self.assertFalse(self.escaped())
+                self.assertEqual(os.listdir(self.root), [])
+
+    def test_symlink_chain_is_rejected_without_data_filter(self) -> None:
+        archive = os.path.join(self.workdir, 'chain.tar.gz')
+        symlink_chain_archive(archive)
+        with mock.patch.dict(tarfile.__dict__):
+            tarfile.__dict__.pop('data_filter', None)
+            self.assertIsNone(TarExtractor(self.root, 'gz').extract(archive))
+        self.assertFalse(self.escaped())
+
+    def test_regular_archive(self) -> None:
+        archive = os.path.join(self.workdir, 'pkg.tar.gz')
+        plain_archive(archive)
+        for name, extractor in self.extractors():
+            with self.subTest(extractor=name):
+                folder = extractor.extract(archive)
+                self.assertEqual(folder, os.path.join(self.root, 'pkg'))
+                with open(os.path.join(folder, 'link.c'), 'rb') as ifile:
+                    self.assertEqual(ifile.read(), b'int main() { return 0; }\n')
+                self.assertTrue(os.path.islink(os.path.join(folder, 'link.c')))
+
+    def test_check_member(self) -> None:
+        for name, linkname, symlink in (('../x', None, False), ('/etc/passwd', None, False), ('a/l', '../../x', True), ('a/l', '/etc', True)):
+            with self.subTest(name=name, linkname=linkname):
+                with self.assertRaises(ValueError):
+                    Extractor.check_member(name, linkname, symlink)
+        Extractor.check_member('a/l', '../b', True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tools import fileops
+from tools.fileops import swap_directory, transfer
+
+####################################################################################################
+### Section Transfer Tests
+####################################################################################################
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp(prefix='test-fileops-')
+        self.source = os.path.join(self.workdir, 'source.txt')
+        with open(self.source, 'wb') as ofile:
+            ofile.write(b'source')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_hardlink_onto_same_inode(self) -> None:
+        target = os.path.join(self.workdir, 'target.txt')
+        os.link(self.source, target)
+        self.assertEqual(transfer(self.source, target, ('hardlink', 'copy')), 'hardlink')
+        self.assertTrue(os.path.samefile(self.source, target))
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['source.txt', 'target.txt'])
+
+    def test_copy_keeps_target_mode(self) -> None:
+        target = os.path.join(self.workdir, 'target.txt')
+        with open(target, 'wb') as ofile:
+            ofile.write(b'old')
+        os.chmod(target, 0o600)
+        self.assertEqual(transfer(self.source, target, ('copy', )), 'copy')
+        self.assertEqual(os.stat(target).st_mode & 0o777, 0o600)
+        with open(target, 'rb') as ifile:
+            self.assertEqual(ifile.read(), b'source')
+
+
+####################################################################################################
+### Section Directory Swap Tests
+####################################################################################################
+
+class SwapDirectoryTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.workdir = tempfile.mkdtemp(prefix='test-fileops-')
+        self.target = os.path.join(self.workdir, 'html')
+        self.staging = os.path.join(self.workdir, '.html.staging')
+        for folder, content in ((self.target, b'old'), (self.staging, b'new')):
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'index.html'), 'wb') as ofile:
+                ofile.write(content)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def read(self) -> bytes:
+        with open(os.path.join(self.target, 'index.html'), 'rb') as ifile:
+            return ifile.read()
+
+    def test_rename_fallback_with_trailing_separator(self) -> None:
+        with mock.patch.object(fileops, 'exchange', side_effect=OSError(38, 'renameat2 not available')):
+            self.assertEqual(swap_directory(self.staging, self.target + os.sep), 'rename')
+        self.assertEqual(self.read(), b'new')
+        self.assertEqual(os.listdir(self.workdir), ['html'])
+
+    def test_rename_fallback_restores_target(self) -> None:
+        replace = os.replace
+        def failing(source: str, target: str) -> None:
+            if source == self.staging:
+                raise OSError(5, 'injected failure')
+            replace(source, target)
+        with mock.patch.object(fileops, 'exchange', side_effect=OSError(38, 'renameat2 not available')), mock.patch.object(fileops, 'os_replace', side_effect=failing):
+            with self.assertRaises(OSError):
+                swap_directory(self.staging, self.target + os.sep)
+        self.assertEqual(self.read(), b'old')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from tools import precompress
+from tools.precompress import CfgPrecompress, Precompressor
+
+####################################################################################################
+### Section Precompressor Tests
+####################################################################################################
+
+class PrecompressorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp(prefix='test-precompress-')
+        self.filepath = os.path.join(self.root, 'a.js')
+        self.record = {}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def deploy(self, data: bytes, cfg: CfgPrecompress) -> None:
+        with open(self.filepath, 'wb') as ofile:
+            ofile.write(data)
+        self.assertEqual(Precompressor(self.record).run(cfg, [(self.filepath, self.filepath, str(len(data)))]), [])
+
+    def test_shrunk_file_drops_sibling(self) -> None:
+        cfg = CfgPrecompress()
+        self.deploy(b'x' * 5000, cfg)
+        with gzip.open(self.filepath + '.gz') as ifile:
+            self.assertEqual(ifile.read(), b'x' * 5000)
+        self.deploy(b'tiny 14 bytes\n', cfg)
+        self.assertFalse(os.path.exists(self.filepath + '.gz'))
+        self.assertEqual(self.record, {})
+
+    def test_unavailable_encoder_drops_sibling(self) -> None:
+        cfg = CfgPrecompress(formats=('gz', 'zst'))
+        with mock.patch.object(precompress, 'encoder_available', return_value=True), mock.patch.dict(precompress.ENCODERS, {'zst': (lambda data, level: data[:10], 19)}):
+            self.deploy(b'x' * 5000, cfg)
+        self.assertTrue(os.path.exists(self.filepath + '.zst'))
+        with mock.patch.object(precompress, 'encoder_available', side_effect=lambda format: format == 'gz'):
+            self.deploy(b'y' * 5000, cfg)
+        self.assertFalse(os.path.exists(self.filepath + '.zst'))
+        self.assertEqual(sorted(self.record), [f'{Precompressor.RECORD_PREFIX}{self.filepath}.gz'])
+
+    def test_untouched_foreign_sibling(self) -> None:
+        with open(self.filepath + '.gz', 'wb') as ofile:
+            ofile.write(b'shipped')
+        self.deploy(b'tiny', CfgPrecompress())
+        self.assertTrue(os.path.exists(self.filepath + '.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,20 @@
 usage:
 
 sudo apt install libxslt-dev
+pip install zstandard               # optional; only for "tzst" sources without the zstd command
 python3 -m tools.sourcekits
+python3 -m tools.buildkit --install --sudo
+python3 -m tools.deploykits
+
+or step by step:
+
 python3 -m tools.template
+python3 -m tools.buildcache restore --sudo  # exit 0: cached build restored, skip to deploykits
 cd <build.openresty>
 bash ./buildcfg.sh
 make -j<N>
 sudo make install
+python3 -m tools.buildcache save
 python3 -m tools.deploykits
 
 '''
\ No newline at end of file
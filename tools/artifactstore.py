@@ -0,0 +1,181 @@
+from contextlib import contextmanager
+from json import load as json_load, dump as json_dump
+from logging import Logger, getLogger
+from os import chmod, makedirs, path, remove, replace, name as os_name
+from threading import RLock
+from time import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .fileops import temp_path, transfer
+
+####################################################################################################
+### Section Artifact Store
+####################################################################################################
+
+class ArtifactStore(object):
+
+    _WINDOWS = os_name == 'nt'
+    FS_BUFFER_SIZE = 1024 * 1024 if _WINDOWS else 64 * 1024
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+    OBJECTS_DIR = 'objects'
+    INCOMING_DIR = 'incoming'
+    DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+    STORE_STRATEGIES = ('hardlink', 'reflink', 'copy')
+    EXPORT_STRATEGIES = ('hardlink', 'reflink', 'copy')
+
+    def __init__(self, root: str, max_size: Optional[int] = DEFAULT_MAX_SIZE, logger: Optional[Logger] = None) -> None:
+        self.root = path.abspath(root)
+        self.max_size = max_size
+        self.logger = logger or getLogger(self.__class__.__name__)
+        self.lock = RLock()
+        makedirs(path.join(self.root, ArtifactStore.OBJECTS_DIR), exist_ok=True)
+
+    def object_path(self, sha256: str) -> str:
+        return path.join(self.root, ArtifactStore.OBJECTS_DIR, sha256[:2], sha256)
+
+    def lookup(self, sha256: Optional[str] = None, key: Optional[str] = None) -> Optional[Tuple[str, str, Optional[str]]]:
+        with self._index() as index:
+            if not sha256 and key:
+                sha256 = index['keys'].get(key)
+            if not sha256:
+                return None
+            sha256 = sha256.lower()
+            entry = index['objects'].get(sha256)
+            if entry is None:
+                return None
+            filepath = self.object_path(sha256)
+            if not path.isfile(filepath):
+                self.logger.warning('artifact %s lost from store; drop it', sha256)
+                self._drop(index, sha256)
+                return None
+            entry['atime'] = time()
+            return sha256, filepath, entry.get('name')
+
+    def put(self, filepath: str, sha256: Optional[str] = None, keys: Iterable[str] = (), name: Optional[str] = None) -> Optional[str]:
+        try:
+            if not sha256:
+                sha256 = ArtifactStore.file_hash(filepath)
+            sha256 = sha256.lower()
+            target = self.object_path(sha256)
+            if not path.isfile(target):
+                makedirs(path.dirname(target), exist_ok=True)
+                strategy = transfer(filepath, target, ArtifactStore.STORE_STRATEGIES, self.logger)
+                if strategy != 'hardlink':
+                    chmod(target, 0o444)
+            with self._index() as index:
+                index['objects'][sha256] = {
+                    'size': path.getsize(target),
+                    'name': name or path.basename(filepath),
+                    'atime': time(),
+                }
+                for key in keys:
+                    index['keys'][key] = sha256
+                self._evict(index, keep=sha256)
+            self.logger.info('stored %s as %s', filepath, sha256)
+            return sha256
+        except Exception as e:
+            self.logger.error('failed to store %s: %s', filepath, e)
+            return None
+
+    def incoming(self, name: str) -> str:
+        incoming_dir = path.join(self.root, ArtifactStore.INCOMING_DIR)
+        makedirs(incoming_dir, exist_ok=True)
+        return temp_path(path.join(incoming_dir, path.basename(name)))
+
+    def export(self, sha256: str, target: str) -> Optional[str]:
+        try:
+            strategy = transfer(self.object_path(sha256), target, ArtifactStore.EXPORT_STRATEGIES, self.logger)
+            self.logger.info('exported %s to %s by %s', sha256, target, strategy)
+            return target
+        except Exception as e:
+            self.logger.error('failed to export %s to %s: %s', sha256, target, e)
+            return None
+
+    def keys(self, prefix: str = '') -> List[Tuple[str, str, float]]:
+        with self._index() as index:
+            result = []
+            for key, sha256 in index['keys'].items():
+                entry = index['objects'].get(sha256)
+                if key.startswith(prefix) and entry:
+                    result.append((key, sha256, entry['atime']))
+            return result
+
+    def discard(self, sha256: str) -> None:
+        with self._index() as index:
+            self._drop(index, sha256)
+
+    def evict(self) -> None:
+        with self._index() as index:
+            self._evict(index)
+
+    def _evict(self, index: Dict, keep: Optional[str] = None) -> None:
+        if self.max_size is None:
+            return
+        objects: Dict[str, Dict] = index['objects']
+        total = sum(entry['size'] for entry in objects.values())
+        for sha256, entry in sorted(objects.items(), key=lambda item: item[1]['atime']):
+            if total <= self.max_size:
+                break
+            if sha256 == keep:
+                continue
+            total -= entry['size']
+            self.logger.info('evict artifact %s (%s, %d bytes)', sha256, entry.get('name'), entry['size'])
+            self._drop(index, sha256)
+
+    def _drop(self, index: Dict, sha256: str) -> None:
+        index['objects'].pop(sha256, None)
+        for key in [key for key, value in index['keys'].items() if value == sha256]:
+            del index['keys'][key]
+        try:
+            remove(self.object_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def _index(self) -> Iterator[Dict]:
+        with self.lock, self._file_lock():
+            index_file = path.join(self.root, ArtifactStore.INDEX_FILE)
+            try:
+                with open(index_file, 'r') as ifile:
+                    index = json_load(ifile)
+            except (FileNotFoundError, ValueError):
+                index = {}
+            index.setdefault('objects', {})
+            index.setdefault('keys', {})
+            yield index
+            tmp = temp_path(index_file)
+            with open(tmp, 'w') as ofile:
+                json_dump(index, ofile, indent=4)
+            replace(tmp, index_file)
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        if ArtifactStore._WINDOWS:
+            yield
+            return
+        from fcntl import flock, LOCK_EX, LOCK_UN
+        with open(path.join(self.root, ArtifactStore.LOCK_FILE), 'a') as lock_file:
+            flock(lock_file.fileno(), LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(lock_file.fileno(), LOCK_UN)
+
+    @staticmethod
+    def file_hash(filepath: str) -> str:
+        import hashlib
+        hasher = hashlib.sha256()
+        with open(filepath, 'rb', buffering=False) as ifile:
+            while chunk := ifile.read(ArtifactStore.FS_BUFFER_SIZE):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def default_root() -> str:
+        from os import environ
+        root = environ.get('HOMELAB_ARTIFACT_CACHE')
+        if root:
+            return root
+        cache_home = environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+        return path.join(cache_home, 'homelab-gateway', 'artifacts')
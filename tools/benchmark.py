@@ -0,0 +1,339 @@
+from argparse import ArgumentParser, Namespace
+from os import makedirs, path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+####################################################################################################
+### Section Benchmark Helpers
+####################################################################################################
+
+def measure(fn: Callable[[], object], repeat: int, setup: Callable[[], object] = None) -> float:
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        begin = perf_counter()
+        fn()
+        elapsed = perf_counter() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(title: str, results: List[Tuple[str, float]]) -> None:
+    print(title)
+    base = results[0][1]
+    for name, elapsed in results:
+        print(f'  {name:<36} {elapsed * 1000:10.2f} ms  x{base / elapsed:5.2f}')
+
+
+####################################################################################################
+### Section Extract Benchmark
+####################################################################################################
+
+def synthetic_tarball(workdir: str, members: int, size: int = 2048) -> str:
+    import tarfile
+    from io import BytesIO
+    from random import Random
+    rnd = Random(members)
+    target = path.join(workdir, f'synthetic-{members}.tar.gz')
+    with tarfile.open(target, 'w:gz') as tar:
+        info = tarfile.TarInfo('synthetic-1.0')
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        for i in range(members):
+            data = bytes(rnd.getrandbits(8) for _ in range(64)) * (size // 64)
+            info = tarfile.TarInfo(f'synthetic-1.0/d{i // 500:03d}/f{i:06d}.c')
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, BytesIO(data))
+    return target
+
+def legacy_tar_extract(archive: str, root: str) -> None:
+    from tarfile import TarFile
+    with TarFile.open(archive, 'r:gz') as tar:
+        folder = None
+        for member in tar:
+            if member.isdir() and folder is None:
+                folder = member.path
+            elif folder is None or not member.path.startswith(folder):
+                folder = None
+                break
+        tar.extractall(root)
+
+def bench_extract(args: Namespace) -> None:
+    from .sourcekits import Extractor
+    workdir = mkdtemp(prefix='bench-extract-', dir=args.workdir)
+    try:
+        archive = args.archive or synthetic_tarball(workdir, args.members, args.size)
+        root = path.join(workdir, 'out')
+        def clean() -> None:
+            rmtree(root, ignore_errors=True)
+            makedirs(root)
+        results = [('legacy two-pass', measure(lambda: legacy_tar_extract(archive, root), args.repeat, clean))]
+        for format in args.formats:
+            extractor = Extractor.get(root, format)
+            results.append((format, measure(lambda: extractor.extract(archive), args.repeat, clean)))
+        report(f'extract {path.basename(archive)}', results)
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+####################################################################################################
+### Section Copy Benchmark
+####################################################################################################
+
+def synthetic_dist(workdir: str, files: int, size: int) -> List[str]:
+    from random import Random
+    rnd = Random(files)
+    root = path.join(workdir, 'dist')
+    names = []
+    for i in range(files):
+        name = path.join(f'assets{i // 100:02d}', f'chunk-{i:05d}.js')
+        target = path.join(root, name)
+        makedirs(path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as ofile:
+            ofile.write(bytes(rnd.getrandbits(8) for _ in range(64)) * max(1, rnd.randint(size // 2, size * 2) // 64))
+        names.append(name)
+    return names
+
+def bench_copy(args: Namespace) -> None:
+    from shutil import copyfile
+    from .fileops import fallback_chain, transfer
+    workdir = mkdtemp(prefix='bench-copy-', dir=args.workdir)
+    try:
+        names = synthetic_dist(workdir, args.files, args.size)
+        source = path.join(workdir, 'dist')
+        root = path.join(args.target_dir or workdir, 'out')
+        def clean() -> None:
+            rmtree(root, ignore_errors=True)
+            for name in names:
+                makedirs(path.dirname(path.join(root, name)), exist_ok=True)
+        def legacy() -> None:
+            for name in names:
+                copyfile(path.join(source, name), path.join(root, name))
+        results = [('shutil.copyfile', measure(legacy, args.repeat, clean))]
+        for strategy in args.strategies:
+            chain = fallback_chain(strategy)
+            used = set()
+            def run() -> None:
+                for name in names:
+                    used.add(transfer(path.join(source, name), path.join(root, name), chain))
+            elapsed = measure(run, args.repeat, clean)
+            results.append((f'{strategy} ({"/".join(sorted(used))})', elapsed))
+        report(f'copy {len(names)} files of ~{args.size} bytes', results)
+        rmtree(root, ignore_errors=True)
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+####################################################################################################
+### Section Template Benchmark
+####################################################################################################
+
+def synthetic_template(workdir: str, size: int) -> str:
+    target = path.join(workdir, 'synthetic.t.conf')
+    with open(target, 'w') as ofile:
+        written = 0
+        i = 0
+        while written < size:
+            line = f'    server 10.0.{i // 250 % 250}.{i % 250}:{{{{ upstream.port }}}} weight={{{{ "upstream.w{i % 50}" }}}}; # {{{{ upstream.name }}}}\n'
+            ofile.write(line)
+            written += len(line)
+            i += 1
+    return target
+
+def legacy_render(template_file: str, variables, output) -> None:
+    from re import compile as re_compile
+    from shlex import quote
+    pattern = re_compile(r'{{\s*("?[a-zA-Z_][\w.-]*"?)\s*}}')
+    parts = []
+    keys = {}
+    with open(template_file, 'r') as f:
+        while line := f.readline():
+            last = 0
+            for m in pattern.finditer(line):
+                key = m.group(1)
+                kind = 1 if key.startswith('"') else 0
+                key = key.strip('"')
+                if line[last:m.start()]:
+                    parts.append(line[last:m.start()])
+                parts.append((key, kind))
+                keys[key] = True
+                last = m.end()
+            if line[last:]:
+                parts.append(line[last:])
+    cache = {key: str(variables[key]) for key in keys}
+    for part in parts:
+        if isinstance(part, str):
+            output.write(part)
+        else:
+            output.write(quote(cache[part[0]]) if part[1] == 1 else cache[part[0]])
+    output.flush()
+
+def bench_template(args: Namespace) -> None:
+    import tracemalloc
+    from glob import glob
+    from io import StringIO
+    from os import devnull
+    from .template import Template
+    from .variables import Variables
+    workdir = mkdtemp(prefix='bench-template-', dir=args.workdir)
+    try:
+        suites = [('conf/*.t.conf', sorted(glob(path.join(args.conf_dir, '*.t.conf'))))]
+        suites.append((f'synthetic {args.size // 1024} KiB', [synthetic_template(workdir, args.size)]))
+        cache_dir = path.join(workdir, 'cache')
+        for title, files in suites:
+            if not files:
+                print(f'{title}: no templates found')
+                continue
+            keys = set()
+            for template_file in files:
+                keys.update(Template(template_file).vars.keys())
+            variables = Variables(path.join(workdir, 'vars.json'), {key: f'value-of-{key}' for key in keys})
+            def legacy() -> None:
+                for template_file in files:
+                    legacy_render(template_file, variables, StringIO())
+            def compiled() -> None:
+                for template_file in files:
+                    Template(template_file).render_into(variables, StringIO())
+            def cached() -> None:
+                for template_file in files:
+                    Template.compile(template_file).render_into(variables, StringIO())
+            def disk_cached() -> None:
+                Template.CACHE.clear()
+                Template.STAT_CACHE.clear()
+                for template_file in files:
+                    Template.compile(template_file, cache_dir).render_into(variables, StringIO())
+            def streamed() -> None:
+                for template_file in files:
+                    with open(template_file, 'r') as ifile, open(devnull, 'w') as output:
+                        Template.render_stream(ifile, variables, output)
+            for template_file in files:
+                Template.compile(template_file, cache_dir)
+            report(f'render {title} ({len(files)} files)', [
+                ('legacy readline', measure(legacy, args.repeat)),
+                ('compiled', measure(compiled, args.repeat)),
+                ('compiled + memory cache', measure(cached, args.repeat)),
+                ('compiled + disk cache', measure(disk_cached, args.repeat)),
+                ('streamed', measure(streamed, args.repeat)),
+            ])
+            def compiled_to_file() -> None:
+                for template_file in files:
+                    with open(devnull, 'w') as output:
+                        Template(template_file).render_into(variables, output)
+            print(f'peak memory {title}')
+            for name, fn in (('compiled', compiled_to_file), ('streamed', streamed)):
+                tracemalloc.start()
+                fn()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f'  {name:<36s} {peak / 1024:10.1f} KiB')
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+####################################################################################################
+### Section Variables Benchmark
+####################################################################################################
+
+def synthetic_variables(target: str, keys: int) -> List[str]:
+    from json import dump as json_dump
+    data = {}
+    names = []
+    for i in range(keys):
+        key = f'group{i % 10}.service{i // 10 % 50}.option{i // 500}.value{i}'
+        node = data
+        parts = key.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = f'value-{i}'
+        names.append(key)
+    with open(target, 'w') as ofile:
+        json_dump(data, ofile, indent=4)
+    return names
+
+def bench_variables(args: Namespace) -> None:
+    from json import load as json_load
+    from threading import RLock
+    from .variables import Variables
+    workdir = mkdtemp(prefix='bench-variables-', dir=args.workdir)
+    try:
+        vars_file = path.join(workdir, 'vars.json')
+        keys = synthetic_variables(vars_file, args.keys)
+        lookups = keys * args.rounds
+        with open(vars_file, 'r') as ifile:
+            data = json_load(ifile)
+        lock = RLock()
+        def legacy_get(key: str):
+            with lock:
+                return Variables.plain_get(data, key)
+        variables = Variables(vars_file)
+        variables['group0.service0.option0.value0']
+        def legacy() -> None:
+            for key in lookups:
+                legacy_get(key)
+        def indexed() -> None:
+            for key in lookups:
+                variables[key]
+        def mixed() -> None:
+            for i, key in enumerate(lookups):
+                if i % 100 == 0:
+                    variables[key] = 'changed'
+                variables[key]
+        report(f'get {len(keys)} keys x {args.rounds}', [
+            ('split and walk', measure(legacy, args.repeat)),
+            ('flat index', measure(indexed, args.repeat)),
+            ('flat index, 1% sets', measure(mixed, args.repeat)),
+        ])
+        def eager() -> None:
+            with open(vars_file, 'r') as ifile:
+                json_load(ifile)
+        def lazy() -> None:
+            Variables(vars_file)['group0.service0.option0.value0']
+        report(f'load {len(keys)} keys', [
+            ('json load', measure(eager, args.repeat)),
+            ('load and index', measure(lazy, args.repeat)),
+        ])
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+BENCHMARKS: Dict[str, Callable[[Namespace], None]] = {
+    'extract': bench_extract,
+    'copy': bench_copy,
+    'template': bench_template,
+    'variables': bench_variables,
+}
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    parser = ArgumentParser(description='Benchmark')
+    parser.add_argument('-w', '--workdir', dest='workdir', help='scratch directory, e.g. /dev/shm to keep disk noise out', default=None)
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, help='repeat count; best run is reported', default=3)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    extract_parser = subparsers.add_parser('extract', help='archive extraction')
+    extract_parser.add_argument('-a', '--archive', dest='archive', help='tar.gz archive; synthetic if omitted')
+    extract_parser.add_argument('-n', '--members', dest='members', type=int, help='member count of the synthetic archive', default=20000)
+    extract_parser.add_argument('-s', '--size', dest='size', type=int, help='member size of the synthetic archive', default=8192)
+    extract_parser.add_argument('-f', '--format', dest='formats', nargs='*', help='registered extractor formats', default=['tgz'])
+    copy_parser = subparsers.add_parser('copy', help='deploy copy strategies on a synthetic dist tree')
+    copy_parser.add_argument('-n', '--files', dest='files', type=int, help='file count of the synthetic tree', default=2000)
+    copy_parser.add_argument('-s', '--size', dest='size', type=int, help='average file size of the synthetic tree', default=16384)
+    copy_parser.add_argument('-t', '--target-dir', dest='target_dir', help='copy into this directory, e.g. another filesystem; scratch directory if omitted')
+    copy_parser.add_argument('-S', '--strategy', dest='strategies', nargs='*', help='first strategy of each fallback chain', default=['hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy'])
+    template_parser = subparsers.add_parser('template', help='template compile and render')
+    template_parser.add_argument('-c', '--conf-dir', dest='conf_dir', help='directory of *.t.conf templates', default=path.join(path.dirname(path.dirname(path.abspath(__file__))), 'conf'))
+    template_parser.add_argument('-s', '--size', dest='size', type=int, help='size of the synthetic template in bytes', default=4 * 1024 * 1024)
+    variables_parser = subparsers.add_parser('variables', help='variables lookups')
+    variables_parser.add_argument('-n', '--keys', dest='keys', type=int, help='number of leaf keys', default=5000)
+    variables_parser.add_argument('--rounds', dest='rounds', type=int, help='lookups per key', default=20)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,232 @@
+from fnmatch import fnmatch
+from io import StringIO
+from json import dumps as json_dumps
+from logging import Logger, getLogger
+from os import makedirs, path, remove
+from typing import Dict, Optional
+
+from .artifactstore import ArtifactStore
+from .sourcekits import CfgItemDownload, Extractor
+from .template import Template
+from .variables import Variables
+
+####################################################################################################
+### Section Build Fingerprint
+####################################################################################################
+
+class BuildFingerprint(object):
+
+    VERSION = 1
+    VOLATILE_KEYS = {'build.jobs': '0'}
+
+    class PinnedVariables(object):
+
+        def __init__(self, vars: Variables, pinned: Dict[str, str]) -> None:
+            self.vars = vars
+            self.pinned = pinned
+
+        def __getitem__(self, key: str):
+            if key in self.pinned:
+                return self.pinned[key]
+            return self.vars[key]
+
+    def __init__(self, configure: str, sources: Dict[str, str], modules: Dict[str, str]) -> None:
+        self.configure = configure
+        self.sources = sources
+        self.modules = modules
+
+    def digest(self) -> str:
+        import hashlib
+        payload = json_dumps({
+            'version': BuildFingerprint.VERSION,
+            'configure': self.configure,
+            'sources': self.sources,
+            'modules': self.modules,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def collect(vars: Variables, template_file: str, downloads_cfg: Dict[str, CfgItemDownload], source_store: Optional[ArtifactStore] = None, logger: Optional[Logger] = None) -> 'BuildFingerprint':
+        logger = logger or getLogger(BuildFingerprint.__name__)
+        template = Template.compile(template_file)
+        pinned = BuildFingerprint.PinnedVariables(vars, BuildFingerprint.VOLATILE_KEYS)
+        missing = [key for key in template.vars.keys() if pinned[key] is None]
+        if missing:
+            raise ValueError(f'variables not found for {template_file}: {", ".join(missing)}')
+        output = StringIO()
+        template.render_into(pinned, output)
+        sources: Dict[str, str] = {}
+        modules: Dict[str, str] = {}
+        for key, cfg in downloads_cfg.items():
+            sources[key] = BuildFingerprint._source_hash(vars, key, cfg, source_store, logger)
+            folder = vars[f'build.{key}']
+            if folder:
+                modules[key] = path.basename(path.normpath(str(folder)))
+        return BuildFingerprint(output.getvalue(), sources, modules)
+
+    @staticmethod
+    def _source_hash(vars: Variables, key: str, cfg: CfgItemDownload, source_store: Optional[ArtifactStore], logger: Logger) -> str:
+        pinned = cfg.validate.data if cfg.validate and cfg.validate.type == 'sha256' else None
+        if source_store:
+            found = source_store.lookup(sha256=pinned, key=None if pinned else cfg.url)
+            if found:
+                return found[0]
+        cache = vars[f'_dlcache.{key}']
+        if cache:
+            _, _, downloaded = str(cache).partition(';')
+            if path.isfile(downloaded):
+                return ArtifactStore.file_hash(downloaded)
+        if pinned:
+            return pinned.lower()
+        logger.warning('no archive hash for %s; fingerprint by url %s', key, cfg.url)
+        return f'url:{cfg.url}'
+
+
+####################################################################################################
+### Section Build Cache
+####################################################################################################
+
+class BuildCache(object):
+
+    KEY_PREFIX = 'build:'
+    DEFAULT_KEEP = 3
+    DEFAULT_PREFIX = '/usr/local/openresty'
+    EXCLUDES = ('nginx/logs/*', 'nginx/*_temp', 'nginx/*_temp/*')
+
+    def __init__(self, store: ArtifactStore, prefix: str = DEFAULT_PREFIX, keep: int = DEFAULT_KEEP, logger: Optional[Logger] = None) -> None:
+        self.store = store
+        self.prefix = path.abspath(prefix)
+        self.keep = keep
+        self.logger = logger or getLogger(self.__class__.__name__)
+
+    def restore(self, fingerprint: str, sudo: bool = False) -> bool:
+        import tarfile
+        found = self.store.lookup(key=BuildCache.KEY_PREFIX + fingerprint)
+        if not found:
+            self.logger.info('no cached build for %s', fingerprint)
+            return False
+        sha256, packed, _ = found
+        try:
+            self.logger.info('restoring build %s from %s into %s', fingerprint, sha256, self.prefix)
+            with tarfile.open(packed, 'r:gz') as tar:
+                if sudo:
+                    for _ in Extractor._safe_members(tar, self.prefix):
+                        pass
+                else:
+                    makedirs(self.prefix, exist_ok=True)
+                    Extractor._extractall(tar, self.prefix)
+            if sudo and not self._sudo(['mkdir', '-p', self.prefix], ['tar', '-xzf', packed, '-C', self.prefix]):
+                return False
+            self.logger.info('restored build %s', fingerprint)
+            return True
+        except Exception as e:
+            self.logger.error('failed to restore build %s: %s', fingerprint, e)
+            return False
+
+    def _sudo(self, *commands) -> bool:
+        from subprocess import run
+        for command in commands:
+            command = ['sudo', *command]
+            self.logger.info('run %s', ' '.join(command))
+            result = run(command)
+            if result.returncode != 0:
+                self.logger.error('%s failed with exit code %d', ' '.join(command), result.returncode)
+                return False
+        return True
+
+    def save(self, fingerprint: str) -> Optional[str]:
+        import tarfile
+        from os import listdir
+        if not path.isdir(self.prefix):
+            self.logger.error('installed tree %s not found', self.prefix)
+            return None
+        name = f'openresty-build-{fingerprint[:16]}.tar.gz'
+        packed = self.store.incoming(name)
+        try:
+            self.logger.info('packing %s for build %s', self.prefix, fingerprint)
+            with tarfile.open(packed, 'w:gz', compresslevel=6) as tar:
+                for entry in sorted(listdir(self.prefix)):
+                    tar.add(path.join(self.prefix, entry), arcname=entry, filter=self._filter)
+            sha256 = self.store.put(packed, keys=(BuildCache.KEY_PREFIX + fingerprint, ), name=name)
+        finally:
+            try:
+                remove(packed)
+            except FileNotFoundError:
+                pass
+        if sha256:
+            self._prune()
+        return sha256
+
+    def _filter(self, info):
+        for pattern in BuildCache.EXCLUDES:
+            if fnmatch(info.name, pattern):
+                return None
+        if info.issym() and path.isabs(info.linkname):
+            linkname = path.normpath(info.linkname)
+            if linkname == self.prefix or linkname.startswith(self.prefix + path.sep):
+                info.linkname = path.relpath(linkname, path.dirname(path.join(self.prefix, info.name)))
+            else:
+                self.logger.warning('link %s -> %s points outside %s; restore will reject it', info.name, info.linkname, self.prefix)
+        return info
+
+    def _prune(self) -> None:
+        builds = sorted(self.store.keys(BuildCache.KEY_PREFIX), key=lambda item: item[2], reverse=True)
+        kept = set()
+        for key, sha256, _ in builds:
+            if len(kept) < self.keep or sha256 in kept:
+                kept.add(sha256)
+                continue
+            self.logger.info('evict cached build %s', key[len(BuildCache.KEY_PREFIX):])
+            self.store.discard(sha256)
+
+    @staticmethod
+    def default_root() -> str:
+        return path.join(path.dirname(ArtifactStore.default_root()), 'builds')
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    import logging
+    import sys
+    from argparse import ArgumentParser
+    from .sourcekits import load_config
+    logging.basicConfig(level=logging.INFO)
+    ROOT, _ = path.split(sys.argv[0])
+    WORKSPACE = 'build'
+    VARS_FILE = path.join(WORKSPACE, 'deploy.vars.json')
+    CFG_FILE = path.join(ROOT, 'openresty-build-downloads.json')
+    INPUT_FILE = path.join(ROOT, 'buildcfg.t.sh')
+    parser = ArgumentParser(description='BuildCache')
+    parser.add_argument('action', choices=['fingerprint', 'restore', 'save'], help='print the fingerprint, restore a cached build (exit 1 on miss) or save the installed tree')
+    parser.add_argument('-i', '--input', dest='input', help='build template file', default=INPUT_FILE)
+    parser.add_argument('-c', '--config', dest='config', help='source download config', default=CFG_FILE)
+    parser.add_argument('-v', '--variables-file', dest='vars_file', help='variables file', default=VARS_FILE)
+    parser.add_argument('--prefix', dest='prefix', help='installed tree; default from build.prefix', default=None)
+    parser.add_argument('--source-cache-dir', dest='source_cache_dir', help='artifact store of source archives', default=ArtifactStore.default_root())
+    parser.add_argument('--cache-dir', dest='cache_dir', help='store of packed builds', default=BuildCache.default_root())
+    parser.add_argument('--cache-size', dest='cache_size', type=int, help='packed build store size cap in MiB', default=ArtifactStore.DEFAULT_MAX_SIZE // (1024 * 1024))
+    parser.add_argument('--keep', dest='keep', type=int, help='number of cached builds to keep', default=BuildCache.DEFAULT_KEEP)
+    parser.add_argument('--force', dest='force', action='store_true', help='ignore a cached build on restore')
+    parser.add_argument('--sudo', dest='sudo', action='store_true', help='restore into the installed tree through sudo')
+    args = parser.parse_args()
+    variables = Variables(args.vars_file)
+    source_store = ArtifactStore(args.source_cache_dir) if path.isdir(args.source_cache_dir) else None
+    fingerprint = BuildFingerprint.collect(variables, args.input, load_config(args.config), source_store).digest()
+    if args.action == 'fingerprint':
+        print(fingerprint)
+        sys.exit(0)
+    prefix = args.prefix or variables['build.prefix'] or BuildCache.DEFAULT_PREFIX
+    cache = BuildCache(ArtifactStore(args.cache_dir, args.cache_size * 1024 * 1024), prefix, args.keep)
+    if args.action == 'restore':
+        if args.force:
+            logging.info('forced rebuild; cached build %s ignored', fingerprint)
+            sys.exit(1)
+        if not cache.restore(fingerprint, args.sudo):
+            sys.exit(1)
+    elif not cache.save(fingerprint):
+        sys.exit(1)
+    variables['build.fingerprint'] = fingerprint
+    variables.sync()
@@ -38,4 +38,4 @@
 --with-pcre={{ "build.libpcre" }} \
 --with-zlib={{ "build.libzlib" }} \
 --with-openssl={{ "build.libssl" }} \
--j4
\ No newline at end of file
+-j{{ build.jobs }}
\ No newline at end of file
@@ -0,0 +1,188 @@
+from logging import Logger, getLogger
+from os import environ, path
+from subprocess import run
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from .artifactstore import ArtifactStore
+from .buildcache import BuildCache, BuildFingerprint
+from .sourcekits import CfgItemDownload
+from .template import Template
+from .variables import Variables
+
+####################################################################################################
+### Section Build Resources
+####################################################################################################
+
+def cpu_budget() -> int:
+    from os import cpu_count
+    try:
+        from os import sched_getaffinity
+        return len(sched_getaffinity(0))
+    except (ImportError, OSError):
+        return cpu_count() or 1
+
+def memory_available() -> Optional[int]:
+    try:
+        with open('/proc/meminfo', 'r') as ifile:
+            for line in ifile:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def auto_jobs(memory_per_job: int) -> int:
+    jobs = cpu_budget()
+    memory = memory_available()
+    if memory is not None and memory_per_job > 0:
+        jobs = min(jobs, memory // memory_per_job)
+    return max(1, jobs)
+
+
+####################################################################################################
+### Section Build Workflow
+####################################################################################################
+
+class BuildKit(object):
+
+    SCRIPT_FILE = 'buildcfg.sh'
+    CCACHE_MASQUERADE = '/usr/lib/ccache'
+
+    def __init__(self, vars: Variables, template_file: str, jobs: int, ccache: bool = True, cache: Optional[BuildCache] = None, logger: Optional[Logger] = None) -> None:
+        self.vars = vars
+        self.template_file = template_file
+        self.jobs = jobs
+        self.ccache = ccache
+        self.cache = cache
+        self.logger = logger or getLogger(self.__class__.__name__)
+        self.timings: List[Tuple[str, float]] = []
+
+    def build(self, downloads_cfg: Dict[str, CfgItemDownload], install: bool = False, sudo: bool = False, force: bool = False, source_store: Optional[ArtifactStore] = None) -> bool:
+        source_dir = self.vars['build.openresty']
+        if not source_dir or not path.isdir(source_dir):
+            self.logger.error('openresty source %s not found; run tools.sourcekits first', source_dir)
+            return False
+        self.vars.sys['build.jobs'] = str(self.jobs)
+        if not self._phase('render', lambda: self.render(path.join(source_dir, BuildKit.SCRIPT_FILE))):
+            return False
+        fingerprint = None
+        if self.cache:
+            fingerprint = BuildFingerprint.collect(self.vars, self.template_file, downloads_cfg, source_store, self.logger).digest()
+            self.logger.info('build fingerprint %s', fingerprint)
+            if not force and install and self._phase('restore', lambda: self.cache.restore(fingerprint, sudo)):
+                self._finish(fingerprint)
+                return True
+        env = self._environment(source_dir)
+        if not self._phase('configure', lambda: self._run(['bash', f'./{BuildKit.SCRIPT_FILE}'], source_dir, env)):
+            return False
+        if not self._phase('make', lambda: self._run(['make', f'-j{self.jobs}'], source_dir, env)):
+            return False
+        if not install:
+            self._finish(None)
+            return True
+        command = ['sudo', 'make', 'install'] if sudo else ['make', 'install']
+        if not self._phase('install', lambda: self._run(command, source_dir, env)):
+            return False
+        if self.cache and fingerprint:
+            self._phase('save', lambda: self.cache.save(fingerprint) is not None)
+        self._finish(fingerprint)
+        return True
+
+    def render(self, output_file: str) -> bool:
+        template = Template.compile(self.template_file)
+        missing = [key for key in template.vars.keys() if self.vars[key] is None]
+        if missing:
+            self.logger.error('variables not found for %s: %s', self.template_file, ', '.join(missing))
+            return False
+        with open(output_file, 'w') as ofile:
+            template.render_into(self.vars, ofile)
+        self.logger.info('rendered %s to %s', self.template_file, output_file)
+        return True
+
+    def _environment(self, source_dir: str) -> Dict[str, str]:
+        from shutil import which
+        env = dict(environ)
+        if not self.ccache:
+            return env
+        ccache = which('ccache')
+        if not ccache:
+            self.logger.info('ccache not found; build without it')
+            return env
+        env.setdefault('CCACHE_BASEDIR', path.abspath(path.dirname(source_dir)))
+        env.setdefault('CCACHE_NOHASHDIR', '1')
+        if path.isdir(BuildKit.CCACHE_MASQUERADE):
+            env['PATH'] = BuildKit.CCACHE_MASQUERADE + path.pathsep + env.get('PATH', '')
+            self.logger.info('ccache enabled via %s', BuildKit.CCACHE_MASQUERADE)
+        else:
+            env['CC'] = f'{ccache} {env.get("CC", "cc")}'
+            self.logger.info('ccache enabled via CC=%s', env['CC'])
+        return env
+
+    def _run(self, command: List[str], cwd: str, env: Dict[str, str]) -> bool:
+        self.logger.info('run %s in %s', ' '.join(command), cwd)
+        result = run(command, cwd=cwd, env=env)
+        if result.returncode != 0:
+            self.logger.error('%s failed with exit code %d', ' '.join(command), result.returncode)
+            return False
+        return True
+
+    def _phase(self, name: str, action) -> bool:
+        begin = perf_counter()
+        ok = bool(action())
+        elapsed = perf_counter() - begin
+        self.timings.append((name, elapsed))
+        self.logger.info('phase %s %s in %.2fs', name, 'done' if ok else 'failed', elapsed)
+        return ok
+
+    def _finish(self, fingerprint: Optional[str]) -> None:
+        if fingerprint:
+            self.vars['build.fingerprint'] = fingerprint
+        self.vars.sync()
+        total = sum(elapsed for _, elapsed in self.timings)
+        for name, elapsed in self.timings:
+            self.logger.info('timing %-10s %8.2fs', name, elapsed)
+        self.logger.info('timing %-10s %8.2fs', 'total', total)
+
+
+####################################################################################################
+####################################################################################################
+####################################################################################################
+
+if __name__ == '__main__':
+    import logging
+    import sys
+    from argparse import ArgumentParser
+    from .sourcekits import load_config
+    logging.basicConfig(level=logging.INFO)
+    ROOT, _ = path.split(sys.argv[0])
+    WORKSPACE = 'build'
+    VARS_FILE = path.join(WORKSPACE, 'deploy.vars.json')
+    CFG_FILE = path.join(ROOT, 'openresty-build-downloads.json')
+    INPUT_FILE = path.join(ROOT, 'buildcfg.t.sh')
+    MEMORY_PER_JOB = 512
+    parser = ArgumentParser(description='BuildKit')
+    parser.add_argument('-i', '--input', dest='input', help='build template file', default=INPUT_FILE)
+    parser.add_argument('-c', '--config', dest='config', help='source download config', default=CFG_FILE)
+    parser.add_argument('-v', '--variables-file', dest='vars_file', help='variables file', default=VARS_FILE)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='parallel jobs; derived from CPUs and available memory by default', default=None)
+    parser.add_argument('--memory-per-job', dest='memory_per_job', type=int, help='MiB of memory reserved per job for the default job count', default=MEMORY_PER_JOB)
+    parser.add_argument('--no-ccache', dest='ccache', action='store_false', help='do not use ccache even when installed')
+    parser.add_argument('--install', dest='install', action='store_true', help='run make install and cache the installed tree')
+    parser.add_argument('--sudo', dest='sudo', action='store_true', help='run make install and the cached build restore through sudo')
+    parser.add_argument('--force', dest='force', action='store_true', help='rebuild even if a cached build matches')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help='do not restore or save cached builds')
+    parser.add_argument('--source-cache-dir', dest='source_cache_dir', help='artifact store of source archives', default=ArtifactStore.default_root())
+    parser.add_argument('--cache-dir', dest='cache_dir', help='store of packed builds', default=BuildCache.default_root())
+    args = parser.parse_args()
+    jobs = args.jobs or auto_jobs(args.memory_per_job * 1024 * 1024)
+    variables = Variables(args.vars_file)
+    cache = None
+    if not args.no_cache:
+        prefix = variables['build.prefix'] or BuildCache.DEFAULT_PREFIX
+        cache = BuildCache(ArtifactStore(args.cache_dir), prefix)
+    source_store = ArtifactStore(args.source_cache_dir) if path.isdir(args.source_cache_dir) else None
+    kit = BuildKit(variables, args.input, jobs, args.ccache, cache)
+    logging.info('build with %d jobs', jobs)
+    if not kit.build(load_config(args.config), args.install, args.sudo, args.force, source_store):
+        sys.exit(1)
@@ -1,12 +1,19 @@
-from enum import IntFlag
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum, IntEnum, IntFlag
 import hashlib
-from json import load as json_load, dump as json_dump
-from logging import Logger, getLogger
-from os import name as os_name, walk as os_walk, makedirs as os_makedirs, path, remove as os_remove
+from io import RawIOBase, TextIOWrapper
+from json import load as json_load, dumps as json_dumps
+from logging import DEBUG, INFO, WARNING, ERROR, Logger, getLogger
+from os import cpu_count, listdir, name as os_name, walk as os_walk, makedirs as os_makedirs, path, remove as os_remove, replace as os_replace, rmdir, link as os_link, lstat as os_lstat, stat as os_stat, stat_result
 import re
-from shutil import copyfile, rmtree
-from typing import Dict, List, Optional, Union
+from shutil import rmtree
+from stat import S_ISREG
+from threading import Lock
+from time import monotonic, perf_counter, strftime, time
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
+from .fileops import FSYNC_POLICIES, atomic_write, fallback_chain, swap_directory, temp_path, transfer
+from .precompress import CfgPrecompress, Precompressor
 from .template import Template
 from .variables import Variables
 
@@ -19,6 +26,33 @@ class FileDeploymentMode(IntFlag):
     Template = 1,
     Once = 2,
     Clear = 4,
+    Sync = 8,
+    Swap = 16,
+
+class ServiceAction(IntEnum):
+    Nothing = 0,
+    Reload = 1,
+    Restart = 2,
+    DaemonReload = 3,
+
+    @property
+    def verb(self) -> str:
+        return 'daemon-reload' if self is ServiceAction.DaemonReload else self.name.lower()
+
+    def steps(self) -> List['ServiceAction']:
+        if self is ServiceAction.DaemonReload:
+            return [ServiceAction.DaemonReload, ServiceAction.Restart]
+        return [self]
+
+    @staticmethod
+    def load(value: Optional[str]) -> 'ServiceAction':
+        if not value:
+            return ServiceAction.Nothing
+        for action in ServiceAction:
+            if action.verb == value:
+                return action
+        raise ValueError(f'unknown service action {value}; expect reload, restart or daemon-reload')
+
 
 class FileFilter(object):
 
@@ -37,6 +71,8 @@ class FileFilter(object):
 
 class CfgItemFileDeployment(object):
 
+    DEFAULT_COPY = 'reflink'
+
     def __init__(self, source: str, target: str, filter: Optional[Union[str, Dict]] = None, **args) -> None:
         self.source = source
         self.target = target
@@ -54,11 +90,413 @@ class CfgItemFileDeployment(object):
             self.mode &= ~FileDeploymentMode.Once
         if args.get('clear', False):
             self.mode |= FileDeploymentMode.Clear
+        sync = args.get('sync', False)
+        if sync:
+            self.mode |= FileDeploymentMode.Sync
+            self.mode &= ~FileDeploymentMode.Clear
+            if sync == 'swap':
+                if self.mode & FileDeploymentMode.Once:
+                    raise ValueError(f'sync mode swap can not deploy {source} once')
+                self.mode |= FileDeploymentMode.Swap
+        self.copy: str = args.get('copy', CfgItemFileDeployment.DEFAULT_COPY)
+        self.strategies = fallback_chain(self.copy)
+        self.precompress = CfgPrecompress.load(args.get('precompress'))
+        self.fingerprint = CfgFingerprint.load(args.get('fingerprint'))
+        self.service = ServiceAction.load(args.get('service'))
+        if self.fingerprint and self.mode & FileDeploymentMode.Template:
+            raise ValueError(f'can not fingerprint templates of {source}')
         
         
 
 
 
+class CfgFingerprint(object):
+
+    HASH_LENGTH = 8
+    MANIFEST = 'assets.manifest.json'
+    VARS_PREFIX = 'asset.'
+
+    def __init__(self, match: Optional[str] = None, manifest: str = MANIFEST) -> None:
+        self.match = re.compile(match) if match else None
+        self.manifest = manifest
+
+    def accept(self, rel_filename: str) -> bool:
+        return rel_filename != self.manifest and (self.match is None or self.match.search(rel_filename) is not None)
+
+    @staticmethod
+    def fingerprinted(rel_filename: str, hash: str) -> str:
+        dirname, filename = path.split(rel_filename)
+        stem, ext = path.splitext(filename)
+        filename = f'{stem}.{hash[:CfgFingerprint.HASH_LENGTH]}{ext}'
+        return path.join(dirname, filename) if dirname else filename
+
+    @staticmethod
+    def load(value: Union[bool, Dict, None]) -> Optional['CfgFingerprint']:
+        if not value:
+            return None
+        if value is True:
+            return CfgFingerprint()
+        return CfgFingerprint(**value)
+
+
+class DeferredLog(object):
+
+    def __init__(self) -> None:
+        self.records: List[Tuple[int, str, Tuple]] = []
+
+    def debug(self, msg: str, *args) -> None:
+        self.records.append((DEBUG, msg, args))
+
+    def info(self, msg: str, *args) -> None:
+        self.records.append((INFO, msg, args))
+
+    def warning(self, msg: str, *args) -> None:
+        self.records.append((WARNING, msg, args))
+
+    def error(self, msg: str, *args) -> None:
+        self.records.append((ERROR, msg, args))
+
+    def flush(self, logger: Logger) -> None:
+        for level, msg, args in self.records:
+            logger.log(level, msg, *args)
+        self.records.clear()
+
+
+
+####################################################################################################
+### Section File Index Components
+####################################################################################################
+
+class FileIndex(object):
+
+    _WINDOWS = os_name == 'nt'
+    FS_CHUNK_SIZE = 1024 * 1024 if _WINDOWS else 64 * 1024
+
+    def __init__(self, index_file: Optional[str] = None, logger: Optional[Logger] = None) -> None:
+        self.index_file = index_file
+        self.logger = logger or getLogger(self.__class__.__name__)
+        self.entries: Dict[str, List] = {}
+        self.lock = Lock()
+        self.modified = False
+        if index_file:
+            try:
+                with open(index_file, 'r') as ifile:
+                    self.entries = json_load(ifile)
+            except FileNotFoundError:
+                self.logger.debug('can not find index file %s; use empty', index_file)
+            except ValueError as e:
+                self.logger.warning('invalid index file %s: %s; use empty', index_file, e)
+
+    def lookup(self, filepath: str, st: stat_result) -> Optional[str]:
+        entry = self.entries.get(path.abspath(filepath))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[2] == st.st_ino:
+            return entry[3]
+        return None
+
+    def hash(self, filepath: str, st: Optional[stat_result] = None) -> str:
+        if st is None:
+            st = os_stat(filepath)
+        hash = self.lookup(filepath, st)
+        if hash is None:
+            hash = FileIndex.file_hash(filepath)
+            self.update(filepath, hash, st)
+        return hash
+
+    def update(self, filepath: str, hash: str, st: Optional[stat_result] = None) -> None:
+        if st is None:
+            st = os_stat(filepath)
+        with self.lock:
+            self.entries[path.abspath(filepath)] = [st.st_size, st.st_mtime_ns, st.st_ino, hash]
+            self.modified = True
+
+    def discard(self, filepath: str) -> None:
+        with self.lock:
+            if self.entries.pop(path.abspath(filepath), None) is not None:
+                self.modified = True
+
+    def move(self, source_dir: str, target_dir: str) -> None:
+        source_dir = path.join(path.abspath(source_dir), '')
+        target_dir = path.join(path.abspath(target_dir), '')
+        with self.lock:
+            moved = {}
+            for filepath in list(self.entries.keys()):
+                if filepath.startswith(target_dir):
+                    del self.entries[filepath]
+                elif filepath.startswith(source_dir):
+                    moved[target_dir + filepath[len(source_dir):]] = self.entries.pop(filepath)
+            self.entries.update(moved)
+            self.modified = True
+
+    def sync(self, fsync: bool = False) -> None:
+        if not self.index_file or not self.modified:
+            return
+        try:
+            with self.lock:
+                data = json_dumps(self.entries)
+                self.modified = False
+            atomic_write(self.index_file, data, fsync)
+        except Exception as e:
+            self.logger.error('failed to write index file %s: %s', self.index_file, e)
+
+    @staticmethod
+    def file_hash(target: str) -> str:
+        with open(target, 'rb', buffering=False) as ifile:
+            hasher = hashlib.sha256()
+            while chunk := ifile.read(FileIndex.FS_CHUNK_SIZE):
+                hasher.update(chunk)
+            return hasher.hexdigest()
+
+
+class HashingSink(RawIOBase):
+
+    def __init__(self) -> None:
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.hasher.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+
+####################################################################################################
+### Section Deployment Plan
+####################################################################################################
+
+class DeployActionKind(Enum):
+    Create = 'create'
+    Update = 'update'
+    Skip = 'skip'
+    Delete = 'delete'
+
+
+class DeployAction(object):
+
+    def __init__(self, kind: DeployActionKind, target: str, source: Optional[str] = None, size: int = 0, hash: Optional[str] = None) -> None:
+        self.kind = kind
+        self.target = target
+        self.source = source
+        self.size = size
+        self.hash = hash
+        self.content: Optional[bytes] = None
+
+
+class DeployPlanItem(object):
+
+    def __init__(self, cfg: CfgItemFileDeployment, actions: List[DeployAction], error: Optional[str] = None) -> None:
+        self.cfg = cfg
+        self.actions = actions
+        self.error = error
+        self.elapsed = 0.0
+
+    def changes(self) -> bool:
+        return any(action.kind is not DeployActionKind.Skip for action in self.actions)
+
+    def count(self, kind: DeployActionKind) -> Tuple[int, int]:
+        actions = [action for action in self.actions if action.kind is kind]
+        return len(actions), sum(action.size for action in actions)
+
+
+class DeployPlan(object):
+
+    def __init__(self) -> None:
+        self.items: List[DeployPlanItem] = []
+        self.timings: Dict[str, float] = {}
+        self.generation: Optional[str] = None
+
+    def count(self, kind: DeployActionKind) -> Tuple[int, int]:
+        counts = [item.count(kind) for item in self.items]
+        return sum(count for count, _ in counts), sum(size for _, size in counts)
+
+    def service_action(self) -> ServiceAction:
+        return max((item.cfg.service for item in self.items if not item.error and item.changes()), default=ServiceAction.Nothing)
+
+    def report(self, logger: Logger) -> None:
+        for item in self.items:
+            if item.error:
+                logger.error('plan %s: %s', item.cfg.source, item.error)
+                continue
+            for action in item.actions:
+                level = DEBUG if action.kind is DeployActionKind.Skip else INFO
+                logger.log(level, 'plan %-6s %10d %s', action.kind.value, action.size, action.target)
+            logger.info('plan %s -> %s: %s', item.cfg.source, item.cfg.target, DeployPlan._summary(item.count))
+        logger.info('plan total: %s', DeployPlan._summary(self.count))
+
+    def report_timings(self, logger: Logger) -> None:
+        for item in self.items:
+            logger.info('timing %-40s %8.3fs', item.cfg.target, item.elapsed)
+        for name, elapsed in self.timings.items():
+            logger.info('timing %-40s %8.3fs', name, elapsed)
+
+    @staticmethod
+    def _summary(count) -> str:
+        return ', '.join(f'{kind.value} {number} ({size} bytes)' for kind in DeployActionKind for number, size in [count(kind)])
+
+
+
+####################################################################################################
+### Section Deployment History
+####################################################################################################
+
+class DeployHistory(object):
+
+    GENERATION_FILE = 'generation.json'
+    FILES_DIR = 'files'
+    DEFAULT_KEEP = 5
+
+    def __init__(self, root: str, keep: int = DEFAULT_KEEP, logger: Optional[Logger] = None) -> None:
+        self.root = path.abspath(root)
+        self.keep = max(1, keep)
+        self.logger = logger or getLogger(self.__class__.__name__)
+
+    def generations(self) -> List[str]:
+        try:
+            names = listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if path.isfile(path.join(self.root, name, DeployHistory.GENERATION_FILE)))
+
+    def load(self, generation: str) -> Dict:
+        with open(path.join(self.root, generation, DeployHistory.GENERATION_FILE), 'r') as ifile:
+            return json_load(ifile)
+
+    def snapshot(self, paths: Iterable[str], note: str = '', protect: Optional[str] = None, index: Optional[FileIndex] = None, sources: Optional[Dict[str, str]] = None) -> str:
+        generations = self.generations()
+        previous = self.load(generations[-1]) if generations else {}
+        previous_dir = path.join(self.root, generations[-1]) if generations else self.root
+        previous_files: Dict[str, str] = previous.get('files', {})
+        previous_hashes: Dict[str, str] = previous.get('hashes', {})
+        generation = strftime('%Y%m%d-%H%M%S')
+        serial = 0
+        while f'{generation}-{serial:03d}' in generations or path.lexists(path.join(self.root, f'{generation}-{serial:03d}')):
+            serial += 1
+        generation = f'{generation}-{serial:03d}'
+        generation_dir = path.join(self.root, generation)
+        staging = path.join(self.root, f'.{generation}.tmp')
+        rmtree(staging, ignore_errors=True)
+        files: Dict[str, str] = {}
+        hashes: Dict[str, str] = {}
+        absent: List[str] = []
+        reused = 0
+        for filepath in sorted({path.abspath(filepath) for filepath in paths}):
+            try:
+                st = os_lstat(filepath)
+            except FileNotFoundError:
+                absent.append(filepath)
+                continue
+            if not S_ISREG(st.st_mode):
+                continue
+            saved = path.join(DeployHistory.FILES_DIR, filepath.lstrip(path.sep))
+            os_makedirs(path.dirname(path.join(staging, saved)), exist_ok=True)
+            hash = index.hash(filepath, st) if index else None
+            if self._reuse(previous_dir, previous_files.get(filepath), st, hash, previous_hashes.get(filepath), path.join(staging, saved)):
+                reused += 1
+            else:
+                transfer(filepath, path.join(staging, saved), fallback_chain('hardlink' if st.st_nlink == 1 else 'reflink'), self.logger)
+            files[filepath] = saved
+            if hash:
+                hashes[filepath] = hash
+        os_makedirs(staging, exist_ok=True)
+        atomic_write(path.join(staging, DeployHistory.GENERATION_FILE), json_dumps({
+            'created': time(),
+            'note': note,
+            'files': files,
+            'hashes': hashes,
+            'absent': absent,
+            'sources': sources or {},
+        }, indent=4))
+        os_replace(staging, generation_dir)
+        self.logger.info('recorded generation %s of %d files (%d shared with %s, %d absent)', generation, len(files), reused, generations[-1] if generations else None, len(absent))
+        for expired in (generations + [generation])[:-self.keep]:
+            if expired == protect:
+                continue
+            rmtree(path.join(self.root, expired), ignore_errors=True)
+            self.logger.info('dropped generation %s', expired)
+        return generation
+
+    @staticmethod
+    def _reuse(previous_dir: str, previous_saved: Optional[str], st: stat_result, hash: Optional[str], previous_hash: Optional[str], target: str) -> bool:
+        if not previous_saved:
+            return False
+        previous_path = path.join(previous_dir, previous_saved)
+        try:
+            previous_st = os_lstat(previous_path)
+            if (previous_st.st_dev, previous_st.st_ino) != (st.st_dev, st.st_ino) and not (hash and hash == previous_hash):
+                return False
+            os_link(previous_path, target)
+            return True
+        except OSError:
+            return False
+
+    def rollback(self, generation: Optional[str] = None, index: Optional[FileIndex] = None, record: Optional[Dict[str, str]] = None) -> bool:
+        generations = self.generations()
+        if not generations:
+            self.logger.error('no generation recorded in %s', self.root)
+            return False
+        generation = generation or generations[-1]
+        if generation not in generations:
+            self.logger.error('generation %s not found in %s', generation, self.root)
+            return False
+        data = self.load(generation)
+        files: Dict[str, str] = data['files']
+        hashes: Dict[str, str] = data.get('hashes', {})
+        absent: List[str] = data['absent']
+        sources: Dict[str, str] = {}
+        for name in generations:
+            sources.update(self.load(name).get('sources', {}))
+        self.snapshot(list(files.keys()) + absent, f'before rollback to {generation}', protect=generation, index=index, sources=sources)
+        restored = removed = 0
+        touched: Set[str] = set()
+        ok = True
+        for filepath, saved in files.items():
+            saved = path.join(self.root, generation, saved)
+            try:
+                if path.lexists(filepath) and (path.samefile(filepath, saved) or index and hashes.get(filepath) and index.hash(filepath) == hashes[filepath]):
+                    continue
+                os_makedirs(path.dirname(filepath), exist_ok=True)
+                transfer(saved, filepath, fallback_chain('hardlink'), self.logger)
+                touched.add(filepath)
+                restored += 1
+                self.logger.info('restored %s', filepath)
+            except Exception as e:
+                self.logger.error('failed to restore %s: %s', filepath, e)
+                ok = False
+            if index:
+                index.discard(filepath)
+        for filepath in absent:
+            try:
+                os_remove(filepath)
+                touched.add(filepath)
+                removed += 1
+                self.logger.info('removed %s', filepath)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self.logger.error('failed to remove %s: %s', filepath, e)
+                ok = False
+            if index:
+                index.discard(filepath)
+        if record is not None:
+            self._forget(record, touched, sources)
+        self.logger.info('rolled back to generation %s: %d restored, %d removed, %d unchanged', generation, restored, removed, len(files) - restored)
+        return ok
+
+    def _forget(self, record: Dict[str, str], touched: Set[str], sources: Dict[str, str]) -> None:
+        forgotten = [sources[filepath] for filepath in touched if filepath in sources]
+        forgotten.extend(key for key in record if key.startswith(Precompressor.RECORD_PREFIX) and path.abspath(key[len(Precompressor.RECORD_PREFIX):]) in touched)
+        for key in forgotten:
+            if record.pop(key, None) is not None:
+                self.logger.info('forget deploy record %s', key)
+
+
+
 ####################################################################################################
 ### SectionFile Deployment Workflow
 ####################################################################################################
@@ -67,11 +505,20 @@ class DeployKit:
 
     _WINDOWS = os_name == 'nt'
     FS_CHUNK_SIZE = 1024 * 1024 if _WINDOWS else 64 * 1024
+    STREAM_TEMPLATE_SIZE = 4 * 1024 * 1024
 
-    def __init__(self, record_file: str, vars: Variables, interactively: bool = True, logger: Optional[Logger] = None) -> None:
+    def __init__(self, record_file: str, vars: Variables, interactively: bool = True, index: Optional[FileIndex] = None, workers: int = 1, commit_interval: Optional[float] = None, fsync: str = 'commit', history: Optional[DeployHistory] = None, template_cache: Optional[str] = None, logger: Optional[Logger] = None) -> None:
         self.record_file = record_file
         self.vars = vars
         self.interactively = interactively
+        self.index = index or FileIndex()
+        self.workers = max(1, workers)
+        self.commit_interval = commit_interval
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'unknown fsync policy {fsync}; expect one of {", ".join(FSYNC_POLICIES)}')
+        self.fsync = fsync
+        self.history = history
+        self.template_cache = template_cache
         self.logger = logger or getLogger(self.__class__.__name__)
         self.record: Dict[str, str] = {}
         try:
@@ -79,32 +526,342 @@ class DeployKit:
                 self.record = json_load(ifile)
         except FileNotFoundError:
             self.logger.warning('can not find record file %s; use empty', record_file)
+        except ValueError as e:
+            self.logger.warning('invalid record file %s: %s; use empty', record_file, e)
+        self.committed_record = dict(self.record)
+        self.precompressor = Precompressor(self.record, cpu_count() or 1)
+        self.manifests: Dict[str, Dict[str, str]] = {}
+        self.committed_at = monotonic()
 
 
-    def deploy(self, cfg: CfgItemFileDeployment) -> None:
-        if path.isdir(cfg.source):
-            if cfg.mode & FileDeploymentMode.Clear:
-                for dirpath, dirnames, filenames in os_walk(cfg.target):
-                    for filename in filenames:
-                        target = path.join(dirpath, filename)
-                        try:
-                            os_remove(target)
-                        except Exception as e:
-                            self.logger.error('failed to remove file %s: %s in clear mode', target, e)
-                    self.logger.debug('clear folder %s of %s', cfg.target, filenames)
-                    for dirname in dirnames:
-                        target = path.join(dirpath, dirname)
-                        try:
-                            rmtree(target)
-                        except Exception as e:
-                            self.logger.error('failed to remove directory %s: %s in clear mode', target, e)
-                    self.logger.debug('clear folder %s of %s', cfg.target, dirnames)
-                    break
-                self.logger.debug('clear folder %s', cfg.target)
+    def deploy(self, cfg: CfgItemFileDeployment) -> List[Tuple[str, str]]:
+        return self.execute(self.plan([cfg]))
+
+    def plan(self, cfgs: Iterable[CfgItemFileDeployment]) -> 'DeployPlan':
+        begin = perf_counter()
+        cfgs = list(cfgs)
+        for cfg in cfgs:
+            self.fingerprint(cfg)
+        plan = DeployPlan()
+        for cfg in cfgs:
+            plan.items.append(self._plan_item(cfg))
+        plan.timings['plan'] = perf_counter() - begin
+        render_begin = perf_counter()
+        self.render_templates(plan)
+        plan.timings['render'] = perf_counter() - render_begin
+        return plan
+
+    def render_templates(self, plan: 'DeployPlan') -> List[str]:
+        pending = [(item, action) for item in plan.items if not item.error and item.cfg.mode & FileDeploymentMode.Template for action in item.actions if action.kind in (DeployActionKind.Create, DeployActionKind.Update)]
+        templates: Dict[str, Optional[Template]] = {}
+        required: Dict[str, List[str]] = {}
+        for item, action in pending:
+            if action.source in templates:
+                continue
+            try:
+                if DeployKit._streamed(action.source):
+                    template = None
+                    with open(action.source, 'r') as ifile:
+                        keys = Template.scan(ifile, DeployKit.FS_CHUNK_SIZE)
+                else:
+                    template = Template.compile(action.source, self.template_cache)
+                    keys = template.vars
+            except (OSError, ValueError) as e:
+                self.logger.error('failed to compile template %s: %s', action.source, e)
+                item.error = f'invalid template: {e}'
+                continue
+            templates[action.source] = template
+            for key in keys.keys():
+                required.setdefault(key, []).append(action.source)
+        missing = self._resolve_variables(required)
+        for key in missing:
+            self.logger.error('variable %s not found; required by %s', key, ', '.join(required[key]))
+        missing_by_source: Dict[str, List[str]] = {}
+        for key in missing:
+            for source in required[key]:
+                missing_by_source.setdefault(source, []).append(key)
+        for item in plan.items:
+            keys = sorted({key for action in item.actions for key in missing_by_source.get(action.source, ())})
+            if keys and not item.error:
+                item.error = f'missing variables: {", ".join(keys)}'
+        jobs = [(item, action, templates[action.source]) for item, action in pending if not item.error and action.source in templates]
+        def render(job: Tuple[DeployPlanItem, DeployAction, Optional[Template]]) -> None:
+            item, action, template = job
+            try:
+                if template is None:
+                    sink = HashingSink()
+                    with open(action.source, 'r') as ifile, TextIOWrapper(sink) as ofile:
+                        if not Template.render_stream(ifile, self.vars, ofile, DeployKit.FS_CHUNK_SIZE):
+                            raise ValueError('variables not found')
+                        action.size = sink.size
+                        action.hash = sink.hexdigest()
+                else:
+                    rendered = template.render(self.vars)
+                    if rendered is None:
+                        raise ValueError('variables not found')
+                    content = rendered.encode()
+                    action.content = content
+                    action.size = len(content)
+                    action.hash = hashlib.sha256(content).hexdigest()
+                if action.kind is DeployActionKind.Update and self._same_content(action.target, action.size, action.hash):
+                    action.kind = DeployActionKind.Skip
+            except Exception as e:
+                self.logger.error('failed to render template %s: %s', action.source, e)
+                item.error = f'failed to render {action.source}: {e}'
+        if self.workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(render, jobs))
+        else:
+            for job in jobs:
+                render(job)
+        return missing
+
+    def execute(self, plan: 'DeployPlan') -> List[Tuple[str, str]]:
+        begin = perf_counter()
+        errors: List[Tuple[str, str]] = []
+        if self.history:
+            managed = [filepath for item in plan.items if item.changes() for filepath in self._managed_paths(item)]
+            sources = {path.abspath(action.target): action.source for item in plan.items if item.changes() and item.cfg.mode & FileDeploymentMode.Once for action in item.actions if action.kind is not DeployActionKind.Delete}
+            if managed:
+                plan.generation = self.history.snapshot(managed, ', '.join(item.cfg.source for item in plan.items if item.changes()), index=self.index, sources=sources)
+                plan.timings['snapshot'] = perf_counter() - begin
+        for item in plan.items:
+            item_begin = perf_counter()
+            errors.extend(self._execute_item(item))
+            item.elapsed = perf_counter() - item_begin
+            if self.commit_interval is not None and monotonic() - self.committed_at >= self.commit_interval:
+                self.commit(final=False)
+        plan.timings['execute'] = perf_counter() - begin
+        return errors
+
+    def commit(self, final: bool = True) -> None:
+        fsync = self.fsync == 'always' or (final and self.fsync == 'commit')
+        self._sync_file_record(fsync)
+        self.index.sync(fsync)
+        if self.vars.deltas:
+            self.vars.sync(fsync)
+        self.committed_at = monotonic()
+
+    def fingerprint(self, cfg: CfgItemFileDeployment) -> Optional[Dict[str, str]]:
+        if not cfg.fingerprint:
+            return None
+        manifest = self.manifests.get(cfg.target)
+        if manifest is not None:
+            return manifest
+        tasks = self._collect(cfg) or []
+        manifest = {}
+        for source, target in tasks:
+            rel_filename = path.relpath(target, cfg.target)
+            if not cfg.fingerprint.accept(rel_filename):
+                continue
+            fingerprinted = CfgFingerprint.fingerprinted(rel_filename, self.index.hash(source))
+            manifest[rel_filename.replace(path.sep, '/')] = fingerprinted.replace(path.sep, '/')
+            self.vars.sys[CfgFingerprint.VARS_PREFIX + rel_filename.replace(path.sep, '.')] = fingerprinted.replace(path.sep, '/')
+        self.manifests[cfg.target] = manifest
+        self.logger.info('fingerprinted %d files of %s', len(manifest), cfg.source)
+        return manifest
+
+    def _plan_item(self, cfg: CfgItemFileDeployment) -> 'DeployPlanItem':
+        tasks = self._collect(cfg)
+        if tasks is None:
+            return DeployPlanItem(cfg, [], 'invalid source')
+        is_dir = path.isdir(cfg.source)
+        clear = is_dir and bool(cfg.mode & FileDeploymentMode.Clear)
+        actions: List[DeployAction] = []
+        if clear:
+            actions.extend(DeployAction(DeployActionKind.Delete, filepath, size=size) for filepath, size in DeployKit._walk_files(cfg.target))
+        for source, target in tasks:
+            source_st = os_stat(source)
+            exists = not clear and path.lexists(target)
+            kind = DeployActionKind.Update if exists else DeployActionKind.Create
+            hash = None
+            if cfg.mode & FileDeploymentMode.Template:
+                pass
+            elif cfg.mode & FileDeploymentMode.Once:
+                hash = self.index.hash(source, source_st)
+                if self.record.get(source) == hash:
+                    kind = DeployActionKind.Skip
+            elif exists and self._is_unchanged(source, source_st, target):
+                kind = DeployActionKind.Skip
+                hash = self.index.lookup(source, source_st)
+            actions.append(DeployAction(kind, target, source, source_st.st_size, hash))
+        if is_dir and cfg.mode & FileDeploymentMode.Sync:
+            kept = self._kept_targets(cfg, tasks)
+            for filepath, size in DeployKit._walk_files(cfg.target):
+                if path.normpath(filepath) not in kept:
+                    actions.append(DeployAction(DeployActionKind.Delete, filepath, size=size))
+        return DeployPlanItem(cfg, actions)
+
+    def _execute_item(self, item: 'DeployPlanItem') -> List[Tuple[str, str]]:
+        cfg = item.cfg
+        if item.error:
+            self.logger.error('%s: %s', item.error, cfg.source)
+            return [(cfg.source, item.error)]
+        is_dir = path.isdir(cfg.source)
+        files = [action for action in item.actions if action.kind is not DeployActionKind.Delete]
+        if is_dir and cfg.mode & FileDeploymentMode.Clear:
+            self._clear(cfg.target)
+        staging = None
+        if is_dir and cfg.mode & FileDeploymentMode.Swap:
+            staging = DeployKit._staging_path(cfg.target)
+            rmtree(staging, ignore_errors=True)
+            os_makedirs(staging)
+        for dirpath in sorted({path.dirname(action.target) for action in files if staging or action.kind is not DeployActionKind.Skip}):
+            if staging:
+                dirpath = path.join(staging, path.relpath(dirpath, cfg.target))
+            if dirpath:
+                os_makedirs(dirpath, exist_ok=True)
+        errors: List[Tuple[str, str]] = []
+        jobs: List[Tuple[DeployAction, Optional[Template], Optional[str]]] = []
+        for action in files:
+            template = None
+            if cfg.mode & FileDeploymentMode.Template and action.kind is not DeployActionKind.Skip and action.content is None and not DeployKit._streamed(action.source):
+                template = self._prepare_template(action.source)
+                if template is None:
+                    errors.append((action.source, 'missing variables'))
+                    continue
+            staged = path.join(staging, path.relpath(action.target, cfg.target)) if staging else None
+            jobs.append((action, template, staged))
+        def run(job: Tuple[DeployAction, Optional[Template], Optional[str]]) -> Tuple[DeferredLog, Optional[str]]:
+            action, template, staged = job
+            log = DeferredLog()
+            try:
+                if action.kind is DeployActionKind.Skip:
+                    if staged:
+                        os_link(action.target, staged)
+                        self.index.update(staged, action.hash or self.index.hash(action.source))
+                    if cfg.mode & FileDeploymentMode.Once:
+                        log.info('file %s not changed', action.source)
+                    elif cfg.mode & FileDeploymentMode.Template:
+                        log.info('template %s rendered unchanged %s', action.source, action.target)
+                    else:
+                        log.debug('file %s up to date with %s', action.target, action.source)
+                    return log, None
+                if not self._deploy_file_to_file(action.source, staged or action.target, cfg.mode, template, log, cfg.strategies, action.hash, action.content):
+                    return log, 'not deployed'
+                return log, None
+            except Exception as e:
+                log.error('failed to deploy %s to %s: %s', action.source, action.target, e)
+                return log, str(e)
+        if self.workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(run, jobs)
+                errors.extend(self._gather(jobs, results))
+        else:
+            errors.extend(self._gather(jobs, map(run, jobs)))
+        if cfg.precompress and jobs:
+            failed = {source for source, _ in errors}
+            deployed = [(staged or action.target, action.target, self.index.hash(staged or action.target)) for action, _, staged in jobs if action.source not in failed]
+            errors.extend(self.precompressor.run(cfg.precompress, deployed))
+        if cfg.fingerprint and jobs and not errors:
+            errors.extend(self._emit_fingerprints(cfg, jobs, staging))
+        if staging:
+            if errors:
+                self.logger.error('keep %s unchanged; staging %s failed', cfg.target, staging)
+                rmtree(staging, ignore_errors=True)
+            else:
+                try:
+                    method = swap_directory(staging, cfg.target, self.logger)
+                    self.index.move(staging, cfg.target)
+                    self.logger.info('swapped %s into %s by %s', staging, cfg.target, method)
+                except Exception as e:
+                    self.logger.error('failed to swap %s into %s: %s', staging, cfg.target, e)
+                    errors.append((cfg.target, str(e)))
+                    rmtree(staging, ignore_errors=True)
+        elif is_dir and cfg.mode & FileDeploymentMode.Sync:
+            self._remove_stale(cfg.target, [action.target for action in item.actions if action.kind is DeployActionKind.Delete])
+        if errors:
+            self.logger.error('%d of %d files failed to deploy from %s', len(errors), len(files), cfg.source)
+        return errors
+
+    def _emit_fingerprints(self, cfg: CfgItemFileDeployment, jobs: List[Tuple['DeployAction', Optional[Template], Optional[str]]], staging: Optional[str]) -> List[Tuple[str, str]]:
+        manifest = self.fingerprint(cfg) or {}
+        root = staging or cfg.target
+        errors: List[Tuple[str, str]] = []
+        for action, _, staged in jobs:
+            deployed = staged or action.target
+            fingerprinted = manifest.get(path.relpath(action.target, cfg.target).replace(path.sep, '/'))
+            if not fingerprinted:
+                continue
+            siblings = [''] + [sibling[len(deployed):] for sibling in cfg.precompress.siblings(deployed)] if cfg.precompress else ['']
+            for suffix in siblings:
+                source = deployed + suffix
+                target_fingerprinted = path.join(root, fingerprinted) + suffix
+                if not path.isfile(source) or path.lexists(target_fingerprinted) and path.samefile(source, target_fingerprinted):
+                    continue
+                try:
+                    transfer(source, target_fingerprinted, fallback_chain('hardlink'), self.logger)
+                except Exception as e:
+                    self.logger.error('failed to fingerprint %s as %s: %s', source, target_fingerprinted, e)
+                    errors.append((source, str(e)))
+        manifest_file = path.join(root, cfg.fingerprint.manifest)
+        if not staging and not cfg.mode & FileDeploymentMode.Sync:
+            self._retire_fingerprints(cfg, manifest_file, manifest)
+        atomic_write(manifest_file, json_dumps(manifest, indent=4, sort_keys=True))
+        self.logger.info('wrote asset manifest %s', manifest_file)
+        return errors
+
+    def _retire_fingerprints(self, cfg: CfgItemFileDeployment, manifest_file: str, manifest: Dict[str, str]) -> None:
+        try:
+            with open(manifest_file, 'r') as ifile:
+                previous: Dict[str, str] = json_load(ifile)
+        except (FileNotFoundError, ValueError):
+            return
+        current = set(manifest.values())
+        for fingerprinted in previous.values():
+            if fingerprinted in current:
+                continue
+            stale = path.join(cfg.target, fingerprinted)
+            for filepath in [stale] + (cfg.precompress.siblings(stale) if cfg.precompress else []):
+                try:
+                    os_remove(filepath)
+                    self.logger.info('removed stale fingerprinted file %s', filepath)
+                except FileNotFoundError:
+                    pass
+
+    def _gather(self, jobs: List[Tuple['DeployAction', Optional[Template], Optional[str]]], results: Iterable[Tuple['DeferredLog', Optional[str]]]) -> List[Tuple[str, str]]:
+        errors = []
+        for (action, _, _), (log, error) in zip(jobs, results):
+            log.flush(self.logger)
+            if error:
+                errors.append((action.source, error))
+        return errors
 
+    def _managed_paths(self, item: 'DeployPlanItem') -> Set[str]:
+        cfg = item.cfg
+        tasks = [(action.source, action.target) for action in item.actions if action.kind is not DeployActionKind.Delete]
+        managed = self._kept_targets(cfg, tasks)
+        managed.update(path.normpath(action.target) for action in item.actions if action.kind is DeployActionKind.Delete)
+        if cfg.fingerprint:
+            try:
+                with open(path.join(cfg.target, cfg.fingerprint.manifest), 'r') as ifile:
+                    previous: Dict[str, str] = json_load(ifile)
+            except (FileNotFoundError, ValueError):
+                previous = {}
+            for fingerprinted in previous.values():
+                filepath = path.normpath(path.join(cfg.target, fingerprinted))
+                managed.add(filepath)
+                if cfg.precompress:
+                    managed.update(cfg.precompress.siblings(filepath))
+        return managed
+
+    def _kept_targets(self, cfg: CfgItemFileDeployment, tasks: List[Tuple[str, str]]) -> Set[str]:
+        targets = {target for _, target in tasks}
+        if cfg.fingerprint:
+            manifest = self.manifests.get(cfg.target, {})
+            targets.update(path.join(cfg.target, fingerprinted) for fingerprinted in manifest.values())
+            targets.add(path.join(cfg.target, cfg.fingerprint.manifest))
+        if cfg.precompress:
+            targets.update(sibling for target in list(targets) for sibling in cfg.precompress.siblings(target))
+        return {path.normpath(target) for target in targets}
+
+    def _collect(self, cfg: CfgItemFileDeployment) -> Optional[List[Tuple[str, str]]]:
+        tasks: List[Tuple[str, str]] = []
+        if path.isdir(cfg.source):
             for dirpath, dirnames, filenames in os_walk(cfg.source):
+                dirnames.sort()
                 rel_dir_path = path.relpath(dirpath, cfg.source)
-                for filename in filenames:
+                for filename in sorted(filenames):
                     if rel_dir_path == '.':
                         rel_filename = filename
                     else:
@@ -115,94 +872,216 @@ class DeployKit:
                         if not rel_filename:
                             self.logger.debug('file %s not match filter', source)
                             continue
-                    target = path.join(cfg.target, rel_filename)
-                    filepath = path.dirname(target)
-                    if filepath:
-                        os_makedirs(filepath, exist_ok=True)
-                    self._deploy_file_to_file(source, target, cfg.mode)  
+                    tasks.append((source, path.join(cfg.target, rel_filename)))
         elif path.isfile(cfg.source):
-            filepath, filename = path.split(cfg.target)
+            _, filename = path.split(cfg.target)
             if not filename:
                 _, filename = path.split(cfg.source)
                 if cfg.filter:
                     filename = cfg.filter.get_file_name(filename)
                     if not filename:
                         self.logger.warning('file %s not match filter', cfg.source)
-                        return
-                if filepath:
-                    os_makedirs(filepath, exist_ok=True)
-                target = path.join(cfg.target, filename)
-                self._deploy_file_to_file(cfg.source, target, cfg.mode)
+                        return tasks
+                tasks.append((cfg.source, path.join(cfg.target, filename)))
             else:
-                if filepath:
-                    os_makedirs(filepath, exist_ok=True)
-                self._deploy_file_to_file(cfg.source, cfg.target, cfg.mode)
+                tasks.append((cfg.source, cfg.target))
         else:
             self.logger.error('invalid source %s', cfg.source)
-        self._sync_file_record()
-        self.vars.sync()
+            return None
+        return tasks
 
-    
+    def _clear(self, target_dir: str) -> None:
+        for dirpath, dirnames, filenames in os_walk(target_dir):
+            for filename in filenames:
+                target = path.join(dirpath, filename)
+                try:
+                    os_remove(target)
+                except Exception as e:
+                    self.logger.error('failed to remove file %s: %s in clear mode', target, e)
+            self.logger.debug('clear folder %s of %s', target_dir, filenames)
+            for dirname in dirnames:
+                target = path.join(dirpath, dirname)
+                try:
+                    rmtree(target)
+                except Exception as e:
+                    self.logger.error('failed to remove directory %s: %s in clear mode', target, e)
+            self.logger.debug('clear folder %s of %s', target_dir, dirnames)
+            break
+        self.logger.debug('clear folder %s', target_dir)
 
-    def _deploy_file_to_file(self, source: str, target: str, mode: FileDeploymentMode) -> bool:
-        if mode & FileDeploymentMode.Template:
-            template = Template(source)
-            for key in template.vars.keys():
-                value = self.vars[key]
-                if value is None:
-                    if self.interactively:
-                        value = input(f'please input value for {key}: ')
-                        if value:
-                            self.vars[key] = value
-                        else:
-                            self.logger.error('variable %s not found', key)
-                            return False
+    def _remove_stale(self, target_dir: str, stale: List[str]) -> None:
+        target_dir = path.normpath(target_dir)
+        dirpaths = set()
+        for target in stale:
+            try:
+                os_remove(target)
+                self.index.discard(target)
+                self.logger.info('removed stale file %s', target)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self.logger.error('failed to remove stale file %s: %s', target, e)
+            dirpath = path.dirname(path.normpath(target))
+            while dirpath.startswith(target_dir + path.sep):
+                dirpaths.add(dirpath)
+                dirpath = path.dirname(dirpath)
+        for dirpath in sorted(dirpaths, key=lambda dirpath: dirpath.count(path.sep), reverse=True):
+            try:
+                rmdir(dirpath)
+                self.logger.info('removed stale directory %s', dirpath)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _walk_files(target_dir: str) -> List[Tuple[str, int]]:
+        files = []
+        for dirpath, dirnames, filenames in os_walk(target_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = path.join(dirpath, filename)
+                try:
+                    files.append((filepath, os_stat(filepath).st_size))
+                except FileNotFoundError:
+                    pass
+        return files
+
+    def _resolve_variables(self, required: Dict[str, List[str]]) -> List[str]:
+        missing = []
+        for key in required:
+            if self.vars[key] is not None:
+                continue
+            if self.interactively:
+                value = input(f'please input value for {key}: ')
+                if value:
+                    self.vars[key] = value
+                    continue
+            missing.append(key)
+        return missing
+
+    def _same_content(self, target: str, size: int, hash: str) -> bool:
+        try:
+            st = os_stat(target)
+        except FileNotFoundError:
+            return False
+        return st.st_size == size and self.index.hash(target, st) == hash
+
+    def _prepare_template(self, source: str) -> Optional[Template]:
+        template = Template.compile(source, self.template_cache)
+        for key in template.vars.keys():
+            value = self.vars[key]
+            if value is None:
+                if self.interactively:
+                    value = input(f'please input value for {key}: ')
+                    if value:
+                        self.vars[key] = value
                     else:
                         self.logger.error('variable %s not found', key)
+                        return None
+                else:
+                    self.logger.error('variable %s not found', key)
+                    return None
+        return template
+
+    def _deploy_file_to_file(self, source: str, target: str, mode: FileDeploymentMode, template: Optional[Template] = None, log: Optional[Union[Logger, 'DeferredLog']] = None, strategies: Tuple[str, ...] = ('copy', ), hash: Optional[str] = None, content: Optional[bytes] = None) -> bool:
+        log = log or self.logger
+        if mode & FileDeploymentMode.Template:
+            if content is None and template is None and DeployKit._streamed(source):
+                return self._deploy_template_stream(source, target, log)
+            if content is None:
+                if template is None:
+                    template = self._prepare_template(source)
+                    if template is None:
                         return False
-            with open(target, 'w') as ofile:
-                template.render_into(self.vars, ofile)
-            self.logger.info('deployed template %s to %s', source, target)
+                content = template.render(self.vars).encode()
+                hash = None
+            atomic_write(target, content)
+            self.index.update(target, hash or hashlib.sha256(content).hexdigest())
+            log.info('deployed template %s to %s', source, target)
             return True
-        new_hash = None
+        strategy = transfer(source, target, strategies, log)
+        log.info('deployed file %s to %s by %s', source, target, strategy)
+        if hash is None:
+            hash = self.index.hash(source)
+        self.index.update(target, hash)
         if mode & FileDeploymentMode.Once:
-            new_hash = self._get_file_hash(source)
-            rec_hash = self.record.get(source)
-            if rec_hash:
-                if rec_hash == new_hash:
-                    self.logger.info('file %s not changed', source)
-                    return True
-            self.record[source] = new_hash
-        copyfile(source, target)
-        self.logger.info('deployed file %s to %s', source, target)
-        if new_hash:
-            self.record[source] = new_hash
-        return True    
+            self.record[source] = hash
+        return True
+
+    def _deploy_template_stream(self, source: str, target: str, log: Union[Logger, 'DeferredLog']) -> bool:
+        tmp = temp_path(target)
+        try:
+            with open(source, 'r') as ifile, open(tmp, 'w') as ofile:
+                if not Template.render_stream(ifile, self.vars, ofile, DeployKit.FS_CHUNK_SIZE):
+                    log.error('variables not found for %s', source)
+                    os_remove(tmp)
+                    return False
+            st = os_stat(tmp)
+            hash = FileIndex.file_hash(tmp)
+            if self._same_content(target, st.st_size, hash):
+                os_remove(tmp)
+                log.info('template %s rendered unchanged %s', source, target)
+                return True
+            os_replace(tmp, target)
+            self.index.update(target, hash, st)
+        except BaseException:
+            if path.lexists(tmp):
+                os_remove(tmp)
+            raise
+        log.info('deployed template %s to %s by streaming', source, target)
+        return True
+
+    @staticmethod
+    def _streamed(source: str) -> bool:
+        try:
+            return os_stat(source).st_size >= DeployKit.STREAM_TEMPLATE_SIZE
+        except FileNotFoundError:
+            return False
+
+    def _is_unchanged(self, source: str, source_st: stat_result, target: str) -> bool:
+        try:
+            target_st = os_stat(target)
+        except FileNotFoundError:
+            return False
+        if target_st.st_size != source_st.st_size:
+            return False
+        source_hash = self.index.lookup(source, source_st)
+        target_hash = self.index.lookup(target, target_st)
+        if source_hash is not None and source_hash == target_hash:
+            return True
+        if source_hash is None:
+            source_hash = self.index.hash(source, source_st)
+        if target_hash is None:
+            target_hash = self.index.hash(target, target_st)
+        return source_hash == target_hash
+
+    @staticmethod
+    def _staging_path(target_dir: str) -> str:
+        parent, name = path.split(path.normpath(target_dir))
+        return path.join(parent, f'.{name}.staging')
 
     def _deploy_folder_to_folder(self, source_dir: str, target_dir: str, filter: FileFilter, mode: FileDeploymentMode) -> None:
         pass
 
-    def _sync_file_record(self) -> None:
+    def _sync_file_record(self, fsync: bool = False) -> None:
+        if self.record == self.committed_record:
+            return
         try:
-            with open(self.record_file, 'w') as ofile:
-                json_dump(self.record, ofile, indent=4)
+            record = dict(self.record)
+            atomic_write(self.record_file, json_dumps(record, indent=4), fsync)
+            self.committed_record = record
         except Exception as e:
             self.logger.error('failed to write record file %s: %s', self.record_file, e)
         
     @staticmethod
     def _get_file_hash(target: str) -> str:
-        with open(target, 'rb', buffering=False) as ifile:
-            hasher = hashlib.sha256()
-            while chunk := ifile.read(DeployKit.FS_CHUNK_SIZE):
-                hasher.update(chunk)
-            return hasher.hexdigest()
+        return FileIndex.file_hash(target)
 
 ####################################################################################################
 ####################################################################################################
 ####################################################################################################
 
 
-def main(cfg_file: str, vars_file: str, rec_file: str) -> None:
+def main(cfg_file: str, vars_file: str, rec_file: str, index_file: Optional[str] = None, workers: int = 1, commit_interval: Optional[float] = None, fsync: str = 'commit', dry_run: bool = False, history: Optional[DeployHistory] = None, template_cache: Optional[str] = None, service: str = 'openresty.service', service_hook: Optional[str] = None) -> bool:
     cfg: List[CfgItemFileDeployment] = []
     with open(cfg_file, 'r') as ifile:
         data = json_load(ifile)
@@ -210,21 +1089,91 @@ def main(cfg_file: str, vars_file: str, rec_file: str) -> None:
             cfg.append(CfgItemFileDeployment(**item))
 
     vars = Variables(vars_file)
-    vars.sync()
-    deploy_kit = DeployKit(rec_file, vars)
-    for item in cfg:
-        deploy_kit.deploy(item)
+    deploy_kit = DeployKit(rec_file, vars, interactively=not dry_run, index=FileIndex(index_file), workers=workers, commit_interval=commit_interval, fsync=fsync, history=history, template_cache=template_cache)
+    plan = deploy_kit.plan(cfg)
+    plan.report(deploy_kit.logger)
+    action = plan.service_action()
+    if dry_run:
+        plan.report_timings(deploy_kit.logger)
+        report_service_action(service, action, deploy_kit.logger)
+        return True
+    try:
+        errors = deploy_kit.execute(plan)
+    finally:
+        deploy_kit.commit()
+    plan.report_timings(deploy_kit.logger)
+    for source, error in errors:
+        deploy_kit.logger.error('failed to deploy %s: %s', source, error)
+    report_service_action(service, action, deploy_kit.logger)
+    if errors:
+        return False
+    if service_hook and action is not ServiceAction.Nothing:
+        return run_service_hook(service_hook, service, action, deploy_kit.logger)
+    return True
+
+
+def report_service_action(service: str, action: ServiceAction, logger: Logger) -> None:
+    if action is ServiceAction.Nothing:
+        logger.info('%s: no reload needed', service)
+    else:
+        logger.warning('%s: %s needed', service, ' and '.join(step.verb for step in action.steps()))
+
+
+def run_service_hook(hook: str, service: str, action: ServiceAction, logger: Logger) -> bool:
+    from shlex import split
+    from subprocess import run
+    for step in action.steps():
+        args = split(hook)
+        if step is ServiceAction.DaemonReload:
+            args = [arg for arg in args if '{service}' not in arg]
+        command = [arg.format(service=service, action=step.verb) for arg in args]
+        logger.info('run service hook %s', ' '.join(command))
+        result = run(command)
+        if result.returncode != 0:
+            logger.error('service hook %s failed with exit code %d', ' '.join(command), result.returncode)
+            return False
+    return True
 
 
 
 if __name__ == '__main__':
     import logging
     import sys
-    from os import environ
+    from argparse import ArgumentParser
     logging.basicConfig(level=logging.DEBUG)
     ROOT, _ = path.split(sys.argv[0])
     WORKSPACE = 'build'
     VARS_FILE = path.join(WORKSPACE, 'deploy.vars.json')
     REC_FILE = path.join(WORKSPACE, 'deploy.record.json')
+    INDEX_FILE = path.join(WORKSPACE, 'deploy.index.json')
+    HISTORY_DIR = path.join(WORKSPACE, 'deploy.history')
+    TEMPLATE_CACHE_DIR = path.join(WORKSPACE, 'template.cache')
     CFG_FILE = path.join(ROOT, 'openresty-deploy-mapping.json')
-    main(CFG_FILE, VARS_FILE, REC_FILE)
\ No newline at end of file
+    parser = ArgumentParser(description='DeployKit')
+    parser.add_argument('-c', '--config', dest='config', help='deploy mapping config', default=CFG_FILE)
+    parser.add_argument('-v', '--variables-file', dest='vars_file', help='variables file', default=VARS_FILE)
+    parser.add_argument('-j', '--workers', dest='workers', type=int, help='parallel file workers', default=4)
+    parser.add_argument('--commit-interval', dest='commit_interval', type=float, help='seconds between intermediate commits of record, index and variables; commit once at the end if omitted', default=None)
+    parser.add_argument('--fsync', dest='fsync', choices=FSYNC_POLICIES, help='fsync record, index and variables never, on the final commit or on every commit', default='commit')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', help='report the planned actions without writing anything')
+    parser.add_argument('--keep', dest='keep', type=int, help='number of deploy generations to keep for rollback', default=DeployHistory.DEFAULT_KEEP)
+    parser.add_argument('--no-history', dest='no_history', action='store_true', help='do not record a generation before deploying')
+    parser.add_argument('--history', dest='list_history', action='store_true', help='list recorded generations and exit')
+    parser.add_argument('--rollback', dest='rollback', nargs='?', const='', help='restore the files of a generation (latest by default) and exit', default=None)
+    parser.add_argument('--service', dest='service', help='systemd unit reloaded or restarted by the deployed files', default='openresty.service')
+    parser.add_argument('--service-hook', dest='service_hook', help='command run only when the service needs it, e.g. "sudo systemctl {action} {service}"; a changed unit file runs it as daemon-reload without the {service} arguments, then as restart', default=None)
+    args = parser.parse_args()
+    history = None if args.no_history else DeployHistory(HISTORY_DIR, args.keep)
+    if args.list_history or args.rollback is not None:
+        history = history or DeployHistory(HISTORY_DIR, args.keep)
+        if args.list_history:
+            for generation in history.generations():
+                data = history.load(generation)
+                print(f'{generation}  {len(data["files"]):6d} files  {data["note"]}')
+            sys.exit(0)
+        deploy_kit = DeployKit(REC_FILE, Variables(args.vars_file), index=FileIndex(INDEX_FILE))
+        ok = history.rollback(args.rollback or None, deploy_kit.index, deploy_kit.record)
+        deploy_kit.commit()
+        sys.exit(0 if ok else 1)
+    if not main(args.config, args.vars_file, REC_FILE, INDEX_FILE, args.workers, args.commit_interval, args.fsync, args.dry_run, history, TEMPLATE_CACHE_DIR, args.service, args.service_hook):
+        sys.exit(1)
\ No newline at end of file
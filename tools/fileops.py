@@ -0,0 +1,231 @@
+import errno
+from logging import Logger, getLogger
+from os import chmod, close as os_close, getpid, name as os_name, link as os_link, lstat as os_lstat, open as os_open, path, remove as os_remove, replace as os_replace, stat as os_stat, O_RDONLY, O_WRONLY, O_CREAT, O_EXCL
+from shutil import copyfile
+from stat import S_IMODE, S_ISREG
+from threading import get_ident
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple, Union
+
+####################################################################################################
+### Section File Transfer Strategies
+####################################################################################################
+
+_WINDOWS = os_name == 'nt'
+FICLONE = 0x40049409
+
+def reflink(source: str, target: str) -> None:
+    from fcntl import ioctl
+    src_fd = os_open(source, O_RDONLY)
+    try:
+        dst_fd = os_open(target, O_WRONLY | O_CREAT | O_EXCL, 0o666)
+        try:
+            ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os_close(dst_fd)
+            dst_fd = -1
+            os_remove(target)
+            raise
+        finally:
+            if dst_fd >= 0:
+                os_close(dst_fd)
+    finally:
+        os_close(src_fd)
+
+def hardlink(source: str, target: str) -> None:
+    os_link(source, target)
+
+def copy_range(source: str, target: str) -> None:
+    from os import copy_file_range
+    _copy_fd(source, target, lambda src_fd, dst_fd, count: copy_file_range(src_fd, dst_fd, count))
+
+def sendfile(source: str, target: str) -> None:
+    from os import sendfile as os_sendfile
+    _copy_fd(source, target, lambda src_fd, dst_fd, count: os_sendfile(dst_fd, src_fd, None, count))
+
+def copy(source: str, target: str) -> None:
+    copyfile(source, target)
+
+def _copy_fd(source: str, target: str, step: Callable[[int, int, int], int]) -> None:
+    from os import fstat
+    src_fd = os_open(source, O_RDONLY)
+    try:
+        dst_fd = os_open(target, O_WRONLY | O_CREAT | O_EXCL, 0o666)
+        try:
+            remaining = fstat(src_fd).st_size
+            while remaining > 0:
+                copied = step(src_fd, dst_fd, min(remaining, COPY_CHUNK_SIZE))
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            os_close(dst_fd)
+            dst_fd = -1
+            os_remove(target)
+            raise
+        finally:
+            if dst_fd >= 0:
+                os_close(dst_fd)
+    finally:
+        os_close(src_fd)
+
+
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+
+STRATEGIES: Dict[str, Callable[[str, str], None]] = {
+    'reflink': reflink,
+    'hardlink': hardlink,
+    'copy_file_range': copy_range,
+    'sendfile': sendfile,
+    'copy': copy,
+}
+
+FALLBACK_CHAIN = ('hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy')
+
+def fallback_chain(strategy: str) -> Tuple[str, ...]:
+    if strategy not in STRATEGIES:
+        raise ValueError(f'unknown transfer strategy {strategy}; expect one of {", ".join(FALLBACK_CHAIN)}')
+    return FALLBACK_CHAIN[FALLBACK_CHAIN.index(strategy):]
+
+def temp_path(target: str) -> str:
+    dirname, filename = path.split(target)
+    return path.join(dirname, f'.{filename}.{getpid()}.{get_ident()}.tmp')
+
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS}
+
+_unsupported: Set[Tuple[str, int, int]] = set()
+
+def transfer(source: str, target: str, strategies: Iterable[str] = ('copy', ), logger: Optional[Logger] = None) -> str:
+    logger = logger or getLogger('fileops')
+    tmp = temp_path(target)
+    last_error: Optional[Exception] = None
+    devices: Optional[Tuple[int, int]] = None
+    for name in strategies:
+        strategy = STRATEGIES[name]
+        if name != 'copy':
+            if devices is None:
+                devices = (os_stat(source).st_dev, os_stat(path.dirname(target) or '.').st_dev)
+            if (name, *devices) in _unsupported:
+                continue
+        try:
+            strategy(source, tmp)
+        except OSError as e:
+            logger.debug('transfer %s to %s with %s failed: %s', source, target, name, e)
+            last_error = e
+            if devices is not None and e.errno in UNSUPPORTED_ERRNOS:
+                _unsupported.add((name, *devices))
+            try:
+                os_remove(tmp)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            if name != 'hardlink':
+                _keep_attributes(tmp, target)
+            elif _same_inode(tmp, target):
+                os_remove(tmp)
+                return name
+            os_replace(tmp, target)
+        except Exception:
+            os_remove(tmp)
+            raise
+        return name
+    raise last_error or ValueError(f'no transfer strategy for {source}')
+
+def _same_inode(tmp: str, target: str) -> bool:
+    try:
+        st = os_lstat(target)
+    except FileNotFoundError:
+        return False
+    tmp_st = os_lstat(tmp)
+    return (st.st_dev, st.st_ino) == (tmp_st.st_dev, tmp_st.st_ino)
+
+def _keep_attributes(tmp: str, target: str) -> None:
+    try:
+        st = os_lstat(target)
+    except FileNotFoundError:
+        return
+    if not S_ISREG(st.st_mode):
+        return
+    chmod(tmp, S_IMODE(st.st_mode))
+    if _WINDOWS:
+        return
+    from os import chown
+    tmp_st = os_stat(tmp)
+    if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+        try:
+            chown(tmp, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+
+
+####################################################################################################
+### Section Directory Swap
+####################################################################################################
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+def exchange(source: str, target: str) -> None:
+    import ctypes
+    from os import fsencode, strerror
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, 'renameat2 not available', source)
+    if renameat2(AT_FDCWD, fsencode(source), AT_FDCWD, fsencode(target), RENAME_EXCHANGE) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, strerror(code), source, None, target)
+
+def swap_directory(staging: str, target: str, logger: Optional[Logger] = None) -> str:
+    from shutil import rmtree
+    logger = logger or getLogger('fileops')
+    staging, target = path.normpath(staging), path.normpath(target)
+    if not path.lexists(target):
+        os_replace(staging, target)
+        return 'rename'
+    try:
+        exchange(staging, target)
+        method = 'exchange'
+    except (OSError, AttributeError) as e:
+        logger.debug('exchange %s with %s failed: %s; fall back to renames', staging, target, e)
+        retired = temp_path(target)
+        os_replace(target, retired)
+        try:
+            os_replace(staging, target)
+        except Exception:
+            os_replace(retired, target)
+            raise
+        staging = retired
+        method = 'rename'
+    rmtree(staging, ignore_errors=True)
+    return method
+
+
+####################################################################################################
+### Section Atomic Writes
+####################################################################################################
+
+FSYNC_POLICIES = ('none', 'commit', 'always')
+
+def atomic_write(target: str, data: Union[str, bytes], fsync: bool = False) -> None:
+    from os import fsync as os_fsync
+    tmp = temp_path(target)
+    try:
+        with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as ofile:
+            ofile.write(data)
+            if fsync:
+                ofile.flush()
+                os_fsync(ofile.fileno())
+        os_replace(tmp, target)
+    except BaseException:
+        try:
+            os_remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    if fsync and not _WINDOWS:
+        dir_fd = os_open(path.dirname(target) or '.', O_RDONLY)
+        try:
+            os_fsync(dir_fd)
+        finally:
+            os_close(dir_fd)
@@ -0,0 +1,197 @@
+from logging import Logger, getLogger
+from os import link as os_link, path, remove as os_remove, stat as os_stat, utime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .fileops import atomic_write
+
+####################################################################################################
+### Section Encoders
+####################################################################################################
+
+def encode_gzip(data: bytes, level: int) -> bytes:
+    import gzip
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def encode_brotli(data: bytes, level: int) -> bytes:
+    import brotli
+    return brotli.compress(data, quality=level)
+
+def encode_zstd(data: bytes, level: int) -> bytes:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    if zstandard:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    from shutil import which
+    from subprocess import run
+    binary = which('zstd')
+    if not binary:
+        raise RuntimeError('zstd precompression needs the zstandard package or the zstd command')
+    return run([binary, '-q', '-c', f'-{level}'], input=data, capture_output=True, check=True).stdout
+
+
+ENCODERS: Dict[str, Tuple[Callable[[bytes, int], bytes], int]] = {
+    'gz': (encode_gzip, 9),
+    'br': (encode_brotli, 11),
+    'zst': (encode_zstd, 19),
+}
+
+def encoder_available(format: str) -> bool:
+    if format == 'br':
+        try:
+            import brotli
+            return True
+        except ImportError:
+            return False
+    if format == 'zst':
+        from shutil import which
+        try:
+            import zstandard
+            return True
+        except ImportError:
+            return which('zstd') is not None
+    return format in ENCODERS
+
+def compress_file(filepath: str, formats: Tuple[str, ...], max_ratio: float) -> Dict[str, Optional[int]]:
+    with open(filepath, 'rb') as ifile:
+        data = ifile.read()
+    st = os_stat(filepath)
+    result: Dict[str, Optional[int]] = {}
+    for format in formats:
+        encode, level = ENCODERS[format]
+        encoded = encode(data, level)
+        sibling = f'{filepath}.{format}'
+        if len(encoded) > len(data) * max_ratio:
+            try:
+                os_remove(sibling)
+            except FileNotFoundError:
+                pass
+            result[format] = None
+            continue
+        atomic_write(sibling, encoded)
+        utime(sibling, ns=(st.st_atime_ns, st.st_mtime_ns))
+        result[format] = len(encoded)
+    return result
+
+
+####################################################################################################
+### Section Precompressor
+####################################################################################################
+
+class CfgPrecompress(object):
+
+    EXTENSIONS = ('.html', '.htm', '.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.xml', '.wasm', '.ico', '.ttf', '.otf')
+
+    def __init__(self, formats: Iterable[str] = ('gz', ), min_size: int = 1024, max_ratio: float = 0.9, extensions: Iterable[str] = EXTENSIONS) -> None:
+        self.formats = tuple(formats)
+        for format in self.formats:
+            if format not in ENCODERS:
+                raise ValueError(f'unknown precompress format {format}; expect one of {", ".join(ENCODERS)}')
+        self.min_size = min_size
+        self.max_ratio = max_ratio
+        self.extensions = tuple(extensions)
+
+    def siblings(self, filepath: str) -> List[str]:
+        return [f'{filepath}.{format}' for format in self.formats]
+
+    @staticmethod
+    def load(value: Union[bool, Dict, None]) -> Optional['CfgPrecompress']:
+        if not value:
+            return None
+        if value is True:
+            return CfgPrecompress()
+        return CfgPrecompress(**value)
+
+
+class Precompressor(object):
+
+    RECORD_PREFIX = 'precompress:'
+    SKIPPED = ':skipped'
+
+    def __init__(self, record: Dict[str, str], workers: int = 1, logger: Optional[Logger] = None) -> None:
+        self.record = record
+        self.workers = max(1, workers)
+        self.logger = logger or getLogger(self.__class__.__name__)
+        self.unavailable = set()
+
+    def run(self, cfg: CfgPrecompress, files: List[Tuple[str, str, str]]) -> List[Tuple[str, str]]:
+        formats = tuple(format for format in cfg.formats if self._available(format))
+        unavailable = tuple(format for format in cfg.formats if format not in formats)
+        pending: List[Tuple[str, str, str]] = []
+        for filepath, live, hash in files:
+            if not filepath.endswith(cfg.extensions) or os_stat(filepath).st_size < cfg.min_size:
+                self._discard(filepath, live, cfg.formats)
+                continue
+            self._discard(filepath, live, unavailable)
+            if all(self._reuse(filepath, live, hash, format) for format in formats):
+                continue
+            pending.append((filepath, live, hash))
+        if not pending:
+            return []
+        errors: List[Tuple[str, str]] = []
+        if self.workers > 1 and len(pending) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(pending))) as executor:
+                futures = [executor.submit(compress_file, filepath, formats, cfg.max_ratio) for filepath, _, _ in pending]
+                results = []
+                for future in futures:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        results.append(e)
+        else:
+            results = []
+            for filepath, _, _ in pending:
+                try:
+                    results.append(compress_file(filepath, formats, cfg.max_ratio))
+                except Exception as e:
+                    results.append(e)
+        for (filepath, live, hash), result in zip(pending, results):
+            if isinstance(result, Exception):
+                self.logger.error('failed to precompress %s: %s', filepath, result)
+                errors.append((filepath, str(result)))
+                continue
+            size = os_stat(filepath).st_size
+            for format, encoded in result.items():
+                key = f'{Precompressor.RECORD_PREFIX}{live}.{format}'
+                if encoded is None:
+                    self.record[key] = hash + Precompressor.SKIPPED
+                    self.logger.debug('skip %s for %s; ratio above %.2f', format, filepath, cfg.max_ratio)
+                else:
+                    self.record[key] = hash
+                    self.logger.info('precompressed %s.%s (%d -> %d bytes)', filepath, format, size, encoded)
+        return errors
+
+    def _reuse(self, filepath: str, live: str, hash: str, format: str) -> bool:
+        recorded = self.record.get(f'{Precompressor.RECORD_PREFIX}{live}.{format}')
+        if recorded == hash + Precompressor.SKIPPED:
+            return True
+        if recorded != hash:
+            return False
+        sibling = f'{filepath}.{format}'
+        live_sibling = f'{live}.{format}'
+        if not path.isfile(live_sibling):
+            return False
+        if sibling != live_sibling and not path.lexists(sibling):
+            os_link(live_sibling, sibling)
+        return True
+
+    def _discard(self, filepath: str, live: str, formats: Tuple[str, ...]) -> None:
+        for format in formats:
+            if self.record.pop(f'{Precompressor.RECORD_PREFIX}{live}.{format}', None) is None:
+                continue
+            try:
+                os_remove(f'{filepath}.{format}')
+                self.logger.info('removed stale %s.%s', filepath, format)
+            except FileNotFoundError:
+                pass
+
+    def _available(self, format: str) -> bool:
+        if format in self.unavailable:
+            return False
+        if encoder_available(format):
+            return True
+        self.logger.warning('precompress format %s not available; skip it', format)
+        self.unavailable.add(format)
+        return False
@@ -1,10 +1,15 @@
 from abc import ABC, abstractmethod
-from http.client import HTTPMessage, HTTPResponse
+from contextlib import contextmanager
+from http.client import HTTPException, HTTPMessage, HTTPResponse, IncompleteRead
 from json import loads as json_loads, load as json_load, dump as json_dump
 from logging import Logger, getLogger
-from os import makedirs, mkdir, path, remove, name as os_name
-from typing import Callable, Dict, List, Literal, Optional, Tuple
+from os import makedirs, path, remove, replace, name as os_name
+from io import RawIOBase
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Tuple
+from threading import Lock
+from urllib.error import HTTPError
 from urllib.request import ProxyHandler, Request, build_opener
+from .artifactstore import ArtifactStore
 from .variables import Variables
 
 
@@ -26,7 +31,7 @@ class CfgItemValidate(object):
 
 class CfgItemDownload(object):
 
-    def __init__(self, url: str, format: Literal["tgz", "zip"], file: Optional[str] = None, validate: Optional[Dict] = None) -> None:
+    def __init__(self, url: str, format: Literal["tgz", "tbz", "txz", "tzst", "tar", "zip", "tgz-parallel", "tbz-parallel", "txz-parallel", "zip-parallel", "auto"], file: Optional[str] = None, validate: Optional[Dict] = None) -> None:
         self.url = url
         self.file = file
         self.format = format
@@ -41,9 +46,18 @@ class Downloader(object):
     BUFFER_SIZE = 8192
     FS_BUFFER_SIZE = 1024 * 1024 if _WINDOWS else 64 * 1024
     DISPLAY_INTERVAL = 5
+    PART_SUFFIX = '.part'
+    PART_META_SUFFIX = '.part.json'
+    RETRIES = 3
+    RETRY_DELAY = 1
+    SEGMENT_MIN_SIZE = 1024 * 1024
+    HASH_TYPES = ('sha256', 'sha1', 'md5')
     
-    def __init__(self, root: str, user_agent: Optional[str] = 'Wget/1.21.3', proxies: Optional[Dict[str, str]] = None, logger: Optional[Logger] = None) -> None:
+    def __init__(self, root: str, user_agent: Optional[str] = 'Wget/1.21.3', proxies: Optional[Dict[str, str]] = None, segments: int = 1, retries: int = RETRIES, store: Optional[ArtifactStore] = None, logger: Optional[Logger] = None) -> None:
         self.root = path.abspath(root)
+        self.segments = segments
+        self.retries = retries
+        self.store = store
         if proxies:
             proxy_handler = ProxyHandler(proxies)
             self.opener = build_opener(proxy_handler)
@@ -68,63 +82,348 @@ class Downloader(object):
                     content = data
                 return content
         except Exception as e:
-            self.error('Failed to download content %s: %s', url, e)
+            self.logger.error('Failed to download content %s: %s', url, e)
             return None
 
     def download_and_validate(self, item: CfgItemDownload) -> Optional[str]:
-        filepath = self.download(item.url, item.file)
+        filepath = self._from_store(item)
+        if filepath:
+            return filepath
+        expected = None
+        if item.validate and item.validate.type in Downloader.HASH_TYPES:
+            digest = self._expected_hash(item.url, item.validate)
+            if not digest:
+                return None
+            expected = (item.validate.type, digest)
+        filepath = self.download(item.url, item.file, expected=expected)
         if not filepath:
             return None
-        if item.validate:
+        if item.validate and not expected:
             if not self._validate_general(filepath, item.validate):
                 self.logger.error('Remove %s for validate failure', filepath)
                 remove(filepath)
                 return None
+        if self.store:
+            sha256 = expected[1] if expected and expected[0] == 'sha256' else None
+            self.store.put(filepath, sha256, keys=(item.url, ), name=path.basename(filepath))
         return filepath
 
-    def download(self, url: str, file: Optional[str] = None) -> Optional[str]:
-        from time import time
+    @contextmanager
+    def stream(self, item: CfgItemDownload) -> Iterator['DownloadStream']:
+        from urllib.parse import urlparse
+        expected = None
+        if item.validate and item.validate.type in Downloader.HASH_TYPES:
+            digest = self._expected_hash(item.url, item.validate)
+            if not digest:
+                raise ValueError(f'no expected digest for {item.url}')
+            expected = (item.validate.type, digest)
+        with self.opener.open(Request(item.url)) as resp:
+            resp: HTTPResponse
+            file = item.file or Downloader.parse_filename(resp.headers) or path.basename(urlparse(item.url).path)
+            length = Downloader.parse_content_length(resp.headers)
+            tee = self.store.incoming(file) if self.store else None
+            self.logger.info('Streaming %s as %s [%s]', item.url, file, length)
+            stream = DownloadStream(resp, file, expected, tee, DownloadProgress(self.logger, file, length))
+            try:
+                yield stream
+                if tee and stream.verified:
+                    stream.close()
+                    self.store.put(tee, stream.digest('sha256'), keys=(item.url, ), name=file)
+            finally:
+                stream.close()
+                if tee:
+                    try:
+                        remove(tee)
+                    except FileNotFoundError:
+                        pass
+
+    def in_store(self, item: CfgItemDownload) -> bool:
+        return self._store_lookup(item) is not None
+
+    def _store_lookup(self, item: CfgItemDownload) -> Optional[Tuple[str, str, Optional[str]]]:
+        if not self.store:
+            return None
+        sha256 = None
+        if item.validate and item.validate.type == 'sha256':
+            sha256 = item.validate.data
+        found = self.store.lookup(sha256=sha256, key=None if sha256 else item.url)
+        if found and not sha256 and item.validate and item.validate.type in Downloader.HASH_TYPES:
+            expected = self._expected_hash(item.url, item.validate)
+            if not expected or not self.validate_hash(found[1], item.validate.type, expected.lower()):
+                self.logger.warning('cached artifact %s for %s does not match %s pin; ignore it', found[0], item.url, item.validate.type)
+                return None
+        return found
+
+    def _from_store(self, item: CfgItemDownload) -> Optional[str]:
+        found = self._store_lookup(item)
+        if not found:
+            return None
+        sha256, _, name = found
+        file = item.file or name
+        if not file:
+            return None
         try:
-            req = Request(url)
-            with self.opener.open(req) as resp:
-                resp: HTTPResponse
-                if not file:
-                    file = Downloader.parse_filename(resp.headers)
+            filepath = self._resolve_path(file)
+            makedirs(self.root, exist_ok=True)
+        except Exception as e:
+            self.logger.error('Failed to reuse cached artifact for %s: %s', item.url, e)
+            return None
+        if not self.store.export(sha256, filepath):
+            return None
+        self.logger.info('Reuse cached artifact %s for %s as %s', sha256, item.url, filepath)
+        return filepath
+
+    def download(self, url: str, file: Optional[str] = None, segments: Optional[int] = None, expected: Optional[Tuple[str, str]] = None) -> Optional[str]:
+        from time import sleep
+        segments = segments or self.segments
+        try:
+            filepath = self._resolve_path(file) if file else None
+            state = {
+                'filepath': filepath,
+                'meta': Downloader._load_part_meta(filepath, url) if filepath else None,
+                'algo': expected[0] if expected else None,
+                'hasher': None,
+                'hashed': 0,
+            }
+            attempt = 0
+            while True:
+                before = Downloader._part_progress(state)
+                try:
+                    meta = state['meta']
+                    if meta and meta.get('segments'):
+                        self._download_segmented(url, state['filepath'], meta)
+                    else:
+                        self._download_single(url, state, segments)
+                        if state['meta'].get('segments'):
+                            continue
+                    break
+                except Exception as e:
+                    if Downloader._part_progress(state) > before:
+                        attempt = 0
+                    attempt += 1
+                    if attempt > self.retries or not Downloader._retryable(e):
+                        raise
+                    self.logger.warning('Download %s interrupted (%s); retry %d/%d', url, e, attempt, self.retries)
+                    sleep(Downloader.RETRY_DELAY * attempt)
+            filepath, meta = state['filepath'], state['meta']
+            partpath = filepath + Downloader.PART_SUFFIX
+            length = meta.get('length')
+            size = path.getsize(partpath)
+            if length is not None and size != length:
+                raise ValueError(f'size mismatch {size} != {length}')
+            if expected:
+                self._prepare_hasher(state, size)
+                digest = state['hasher'].hexdigest()
+                if digest != expected[1].lower():
+                    self.logger.error('Remove %s for validate failure: %s %s != %s', partpath, expected[0], digest, expected[1])
+                    remove(partpath)
+                    Downloader._remove_part_meta(filepath)
+                    return None
+                self.logger.info('Validated %s %s %s', path.basename(filepath), expected[0], digest)
+            replace(partpath, filepath)
+            Downloader._remove_part_meta(filepath)
+            return filepath
+        except Exception as e:
+            self.logger.error('Failed to download %s: %s', url, e)
+            return None
+
+    def _download_single(self, url: str, state: Dict, segments: int) -> None:
+        filepath: Optional[str] = state['filepath']
+        meta: Optional[Dict] = state['meta']
+        offset = 0
+        if filepath and meta and meta.get('validator'):
+            try:
+                offset = path.getsize(filepath + Downloader.PART_SUFFIX)
+            except FileNotFoundError:
+                offset = 0
+        req = Request(url)
+        if offset:
+            req.add_header('Range', f'bytes={offset}-')
+            req.add_header('If-Range', meta['validator'])
+        elif segments > 1:
+            req.add_header('Range', 'bytes=0-')
+        try:
+            resp = self.opener.open(req)
+        except HTTPError as e:
+            if e.code == 416 and offset and offset == meta.get('length'):
+                self.logger.info('Download %s already complete in %s', url, filepath + Downloader.PART_SUFFIX)
+                return
+            raise
+        with resp:
+            resp: HTTPResponse
+            if not filepath:
+                file = Downloader.parse_filename(resp.headers)
                 if not file:
                     raise ValueError(f'failed to get filename; {resp.headers.as_string()}')
-                filepath = path.abspath(path.join(self.root, file))
-                if not filepath.startswith(self.root):
-                    raise ValueError(f'access denied to {filepath} with {file}')
+                filepath = self._resolve_path(file)
+                state['filepath'] = filepath
+            validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+            if resp.status == 206:
+                start, _, length = Downloader.parse_content_range(resp.headers)
+                if start != offset:
+                    raise ValueError(f'unexpected range start {start}, expected {offset}')
+            else:
+                offset = 0
+                length = Downloader.parse_content_length(resp.headers)
+            if segments > 1 and resp.status == 206 and offset == 0 and length and length >= Downloader.SEGMENT_MIN_SIZE:
+                meta = Downloader._plan_segments(url, validator, length, segments)
                 makedirs(self.root, exist_ok=True)
-                with open(filepath, 'wb') as ofile:
-                    content_length = Downloader.parse_content_length(resp.headers)
-                    if content_length:
-                        self.logger.info('Downloading %s to %s as %s [%d]', url, filepath, file, content_length)
-                    else:
-                        self.logger.info('Downloading %s to %s as %s', url, filepath, file)
-                    read = 0
-                    last_time = 0
-                    last_display = 0
-                    while chunk := resp.read(Downloader.BUFFER_SIZE):
+                with open(filepath + Downloader.PART_SUFFIX, 'wb') as ofile:
+                    ofile.truncate(length)
+                Downloader._save_part_meta(filepath, meta)
+                state['meta'] = meta
+                return
+            meta = {'url': url, 'validator': validator, 'length': length}
+            makedirs(self.root, exist_ok=True)
+            Downloader._save_part_meta(filepath, meta)
+            state['meta'] = meta
+            file = path.basename(filepath)
+            if offset:
+                self.logger.info('Resuming %s to %s as %s at %d [%s]', url, filepath, file, offset, length)
+            elif length:
+                self.logger.info('Downloading %s to %s as %s [%d]', url, filepath, file, length)
+            else:
+                self.logger.info('Downloading %s to %s as %s', url, filepath, file)
+            progress = DownloadProgress(self.logger, path.basename(filepath), length, offset)
+            hasher = self._prepare_hasher(state, offset)
+            with open(filepath + Downloader.PART_SUFFIX, 'ab' if offset else 'wb') as ofile:
+                while chunk := resp.read(Downloader.BUFFER_SIZE):
+                    ofile.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                        state['hashed'] += len(chunk)
+                    progress.update(len(chunk))
+            progress.finish()
+            if length is not None and progress.read < length:
+                raise IncompleteRead(b'', length - progress.read)
+
+    def _download_segmented(self, url: str, filepath: str, meta: Dict) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        segments: List[List[int]] = meta['segments']
+        length = meta['length']
+        done = sum(seg[1] - seg[0] for seg in segments)
+        self.logger.info('Downloading %s to %s in %d segments [%d]', url, filepath, len(segments), length)
+        progress = DownloadProgress(self.logger, path.basename(filepath), length, done)
+        try:
+            pending = [seg for seg in segments if seg[1] <= seg[2]]
+            with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='segment') as executor:
+                futures = [executor.submit(self._fetch_segment, url, filepath + Downloader.PART_SUFFIX, seg, meta['validator'], progress) for seg in pending]
+                errors = []
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+                if errors:
+                    raise errors[0]
+            progress.finish()
+        finally:
+            Downloader._save_part_meta(filepath, meta)
+
+    def _fetch_segment(self, url: str, partpath: str, segment: List[int], validator: Optional[str], progress: 'DownloadProgress') -> None:
+        from time import sleep
+        attempt = 0
+        while segment[1] <= segment[2]:
+            before = segment[1]
+            try:
+                req = Request(url)
+                req.add_header('Range', f'bytes={segment[1]}-{segment[2]}')
+                if validator:
+                    req.add_header('If-Range', validator)
+                with self.opener.open(req) as resp, open(partpath, 'r+b') as ofile:
+                    if resp.status != 206:
+                        raise ValueError(f'range request ignored with status {resp.status}')
+                    start, _, _ = Downloader.parse_content_range(resp.headers)
+                    if start != segment[1]:
+                        raise ValueError(f'unexpected range start {start}, expected {segment[1]}')
+                    ofile.seek(segment[1])
+                    while segment[1] <= segment[2]:
+                        chunk = resp.read(min(Downloader.BUFFER_SIZE, segment[2] + 1 - segment[1]))
+                        if not chunk:
+                            raise IncompleteRead(b'', segment[2] + 1 - segment[1])
                         ofile.write(chunk)
-                        read += len(chunk)
-                        now = time()
-                        if now - last_time > Downloader.DISPLAY_INTERVAL:
-                            last_time = now
-                            last_display = read
-                            if content_length:
-                                self.logger.info('Downloaded %.2f%%', 100 * read / content_length)
-                            else:
-                                self.logger.info('Downloaded %d bytes', read)
-                    if last_display != read:
-                        if content_length:
-                            self.logger.info('Downloaded %.2f%%', 100 * read / content_length)
-                        else:
-                            self.logger.info('Downloaded %d bytes', read)
-                return filepath
-        except Exception as e:
-            self.logger.error('Failed to download %s: %s', url, e)
+                        segment[1] += len(chunk)
+                        progress.update(len(chunk))
+            except Exception as e:
+                if segment[1] > before:
+                    attempt = 0
+                attempt += 1
+                if attempt > self.retries or not Downloader._retryable(e):
+                    raise
+                self.logger.warning('Segment %d-%d of %s interrupted at %d (%s); retry %d/%d', segment[0], segment[2], url, segment[1], e, attempt, self.retries)
+                sleep(Downloader.RETRY_DELAY * attempt)
+
+    def _prepare_hasher(self, state: Dict, offset: int):
+        import hashlib
+        if not state['algo']:
             return None
+        if state['hasher'] is None or state['hashed'] != offset:
+            hasher = hashlib.new(state['algo'])
+            hashed = 0
+            if offset:
+                with open(state['filepath'] + Downloader.PART_SUFFIX, 'rb', buffering=False) as ifile:
+                    while hashed < offset and (chunk := ifile.read(min(Downloader.FS_BUFFER_SIZE, offset - hashed))):
+                        hasher.update(chunk)
+                        hashed += len(chunk)
+            state['hasher'] = hasher
+            state['hashed'] = hashed
+        return state['hasher']
+
+    def _resolve_path(self, file: str) -> str:
+        filepath = path.abspath(path.join(self.root, file))
+        if not filepath.startswith(self.root):
+            raise ValueError(f'access denied to {filepath} with {file}')
+        return filepath
+
+    @staticmethod
+    def _part_progress(state: Dict) -> int:
+        meta = state['meta']
+        if meta and meta.get('segments'):
+            return sum(seg[1] - seg[0] for seg in meta['segments'])
+        try:
+            return path.getsize(state['filepath'] + Downloader.PART_SUFFIX)
+        except (TypeError, OSError):
+            return 0
+
+    @staticmethod
+    def _retryable(e: Exception) -> bool:
+        if isinstance(e, HTTPError):
+            return e.code >= 500 or e.code in (408, 429)
+        return isinstance(e, (OSError, HTTPException))
+
+    @staticmethod
+    def _plan_segments(url: str, validator: Optional[str], length: int, segments: int) -> Dict:
+        size = max(Downloader.SEGMENT_MIN_SIZE, -(-length // segments))
+        ranges = []
+        for start in range(0, length, size):
+            end = min(start + size, length) - 1
+            ranges.append([start, start, end])
+        return {'url': url, 'validator': validator, 'length': length, 'segments': ranges}
+
+    @staticmethod
+    def _load_part_meta(filepath: str, url: str) -> Optional[Dict]:
+        try:
+            with open(filepath + Downloader.PART_META_SUFFIX, 'r') as ifile:
+                meta = json_load(ifile)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta.get('url') != url or not meta.get('validator'):
+            return None
+        if not path.isfile(filepath + Downloader.PART_SUFFIX):
+            return None
+        return meta
+
+    @staticmethod
+    def _save_part_meta(filepath: str, meta: Dict) -> None:
+        with open(filepath + Downloader.PART_META_SUFFIX, 'w') as ofile:
+            json_dump(meta, ofile)
+
+    @staticmethod
+    def _remove_part_meta(filepath: str) -> None:
+        try:
+            remove(filepath + Downloader.PART_META_SUFFIX)
+        except FileNotFoundError:
+            pass
     
     def validate_hash(self, filepath: str, algo: Literal["sha256", "sha1", "md5"], hash: str) -> Optional[bool]:
         import hashlib
@@ -139,18 +438,23 @@ class Downloader(object):
             self.logger.error('Failed to validate %s: %s', filepath, e)
             return None
         
+    def _expected_hash(self, filepath: str, validate: CfgItemValidate) -> Optional[str]:
+        if validate.data:
+            return validate.data
+        if not validate.url:
+            self.logger.error('Failed to validate %s: no data or url in %s', filepath, validate)
+            return None
+        content = self.content(validate.url)
+        if not content:
+            self.logger.error('Failed to validate %s: can not download data', filepath)
+            return None
+        return content.split()[0].decode('utf-8')
+        
     def _validate_general(self, filepath: str, validate: CfgItemValidate) -> Optional[bool]:
-        if validate.type in ('sha256', 'sha1', 'md5'):
-            _data = validate.data
+        if validate.type in Downloader.HASH_TYPES:
+            _data = self._expected_hash(filepath, validate)
             if not _data:
-                if not validate.url:
-                    self.logger.error('Failed to validate %s: no data or url in %s', filepath, validate)
-                    return None
-                content = self.content(validate.url)
-                if not content:
-                    self.logger.error('Failed to validate %s: can not download data', filepath)
-                    return None
-                _data = content.split()[0].decode('utf-8')
+                return None
             return self.validate_hash(filepath, validate.type, _data)
         if validate.type in ('pgp', ):
             return True #TODO validate pgp
@@ -183,6 +487,112 @@ class Downloader(object):
             except ValueError:
                 pass
         return None
+
+    @staticmethod
+    def parse_content_range(headers: HTTPMessage) -> Tuple[int, int, Optional[int]]:
+        content_range = headers.get('Content-Range')
+        if not content_range:
+            raise ValueError('missing Content-Range in partial response')
+        unit, _, spec = content_range.strip().partition(' ')
+        if unit != 'bytes':
+            raise ValueError(f'unsupported Content-Range {content_range}')
+        span, _, total = spec.partition('/')
+        start, _, end = span.partition('-')
+        return int(start), int(end), (None if total == '*' else int(total))
+    
+
+class DownloadStream(RawIOBase):
+
+    def __init__(self, resp: HTTPResponse, name: str, expected: Optional[Tuple[str, str]], tee: Optional[str], progress: 'DownloadProgress') -> None:
+        import hashlib
+        super().__init__()
+        self.resp = resp
+        self.name = name
+        self.expected = expected
+        self.progress = progress
+        self.hashers = {}
+        if expected:
+            self.hashers[expected[0]] = hashlib.new(expected[0])
+        self.tee = None
+        if tee:
+            self.hashers.setdefault('sha256', hashlib.sha256())
+            self.tee = open(tee, 'wb')
+        self.verified = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self.resp.readinto(buffer)
+        if size:
+            data = memoryview(buffer)[:size]
+            for hasher in self.hashers.values():
+                hasher.update(data)
+            if self.tee:
+                self.tee.write(data)
+            self.progress.update(size)
+        return size
+
+    def verify(self) -> bool:
+        while self.read(Downloader.FS_BUFFER_SIZE):
+            pass
+        self.progress.finish()
+        total = self.progress.total
+        if total is not None and self.progress.read != total:
+            self.progress.logger.error('Stream %s size mismatch %d != %d', self.name, self.progress.read, total)
+            return False
+        if self.expected:
+            algo, expected = self.expected
+            digest = self.digest(algo)
+            if digest != expected.lower():
+                self.progress.logger.error('Stream %s validate failure: %s %s != %s', self.name, algo, digest, expected)
+                return False
+            self.progress.logger.info('Validated %s %s %s', self.name, algo, digest)
+        self.verified = True
+        return True
+
+    def digest(self, algo: str) -> Optional[str]:
+        hasher = self.hashers.get(algo)
+        return hasher.hexdigest() if hasher else None
+
+    def close(self) -> None:
+        if self.tee:
+            self.tee.close()
+            self.tee = None
+        super().close()
+
+
+class DownloadProgress(object):
+
+    def __init__(self, logger: Logger, name: str, total: Optional[int], read: int = 0) -> None:
+        self.logger = logger
+        self.name = name
+        self.total = total
+        self.read = read
+        self.last_time = 0
+        self.last_display = read
+        self.lock = Lock()
+
+    def update(self, size: int) -> None:
+        from time import time
+        with self.lock:
+            self.read += size
+            now = time()
+            if now - self.last_time > Downloader.DISPLAY_INTERVAL:
+                self.last_time = now
+                self._display()
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.last_display != self.read:
+                self._display()
+
+    def _display(self) -> None:
+        self.last_display = self.read
+        if self.total:
+            self.logger.info('Downloaded %s %.2f%%', self.name, 100 * self.read / self.total)
+        else:
+            self.logger.info('Downloaded %s %d bytes', self.name, self.read)
     
 
 
@@ -193,15 +603,128 @@ class Downloader(object):
 class Extractor(ABC):
 
     REGISTERED_EXTRACTORS: Dict[str, Callable[[str],'Extractor']] = {}
+    MAGICS = (
+        (0, b'\x1f\x8b', 'tgz'),
+        (0, b'BZh', 'tbz'),
+        (0, b'\xfd7zXZ\x00', 'txz'),
+        (0, b'\x28\xb5\x2f\xfd', 'tzst'),
+        (0, b'PK\x03\x04', 'zip'),
+        (0, b'PK\x05\x06', 'zip'),
+        (257, b'ustar', 'tar'),
+    )
 
     def __init__(self, root: str, logger: Optional[Logger] = None) -> None:
         self.root = path.abspath(root)
         self.logger = logger or getLogger(self.__class__.__name__)
 
+    streamable = False
+
     @abstractmethod
     def extract(self, target: str) -> Optional[str]:
         return None
+
+    def extract_stream(self, stream: RawIOBase, name: str, verify: Callable[[], bool]) -> Optional[str]:
+        return None
+
+    def _extract_staged(self, name: str, folder_name: str, open_archive: Callable[[], object], verify: Optional[Callable[[], bool]] = None) -> Optional[str]:
+        from shutil import rmtree
+        staging = None
+        try:
+            staging = self._staging()
+            self.logger.info('Extracting %s to %s', name, staging)
+            with open_archive() as archive:
+                self._extract_into(archive, staging)
+            if verify and not verify():
+                self.logger.error('Discard extracted %s for validate failure', name)
+                rmtree(staging)
+                return None
+            output = self._finalize(staging, folder_name)
+            self.logger.info('Extracted %s as %s', name, output)
+            return output
+        except Exception as e:
+            self.logger.error('Failed to extract %s: %s', name, e)
+            if staging:
+                rmtree(staging, ignore_errors=True)
+            return None
+
+    def _staging(self) -> str:
+        from tempfile import mkdtemp
+        makedirs(self.root, exist_ok=True)
+        return mkdtemp(prefix='.extract-', dir=self.root)
+
+    def _finalize(self, staging: str, folder_name: str) -> str:
+        from os import listdir, rename, rmdir
+        from shutil import rmtree
+        entries = listdir(staging)
+        if len(entries) == 1 and path.isdir(path.join(staging, entries[0])):
+            source = path.join(staging, entries[0])
+            output = path.join(self.root, entries[0])
+        else:
+            source = staging
+            output = path.join(self.root, folder_name)
+            self.logger.warning('Unwrapped archive; wrap with folder %s', folder_name)
+        if path.isdir(output):
+            rmtree(output)
+        rename(source, output)
+        if source != staging:
+            rmdir(staging)
+        return output
+
+    def _extract_into(self, archive, folder: str) -> None:
+        Extractor._extractall(archive, folder)
+
+    @staticmethod
+    def _extractall(archive, folder: str) -> None:
+        import tarfile
+        if isinstance(archive, tarfile.TarFile):
+            if hasattr(tarfile, 'data_filter'):
+                archive.extractall(folder, members=Extractor._safe_members(archive), filter='data')
+            else:
+                archive.extractall(folder, members=Extractor._safe_members(archive, folder))
+        else:
+            archive.extractall(folder)
+
+    @staticmethod
+    def _safe_members(tar, folder: Optional[str] = None) -> Iterator:
+        for member in tar:
+            linkname = member.linkname if member.issym() or member.islnk() else None
+            Extractor.check_member(member.name, linkname, member.issym())
+            if member.ischr() or member.isblk() or member.isfifo():
+                raise ValueError(f'special file {member.name} not allowed')
+            if folder:
+                Extractor.check_resolved(folder, member.name, linkname, member.issym())
+            member.mode &= 0o777
+            yield member
+
+    @staticmethod
+    def check_member(name: str, linkname: Optional[str] = None, symlink: bool = False) -> None:
+        from posixpath import dirname, join, normpath
+        def escapes(p: str) -> bool:
+            p = normpath(p)
+            return p.startswith('/') or p == '..' or p.startswith('../')
+        if escapes(name):
+            raise ValueError(f'member {name} escapes the extraction folder')
+        if linkname is not None:
+            target = join(dirname(name), linkname) if symlink else linkname
+            if linkname.startswith('/') or escapes(target):
+                raise ValueError(f'link {name} -> {linkname} escapes the extraction folder')
     
+    @staticmethod
+    def check_resolved(folder: str, name: str, linkname: Optional[str] = None, symlink: bool = False) -> None:
+        root = path.realpath(folder)
+        def inside(p: str) -> bool:
+            return p == root or p.startswith(root + path.sep)
+        parent = path.realpath(path.join(root, path.dirname(name)))
+        if not inside(parent):
+            raise ValueError(f'member {name} escapes the extraction folder through a link')
+        if linkname is None:
+            if not inside(path.realpath(path.join(root, name))):
+                raise ValueError(f'member {name} escapes the extraction folder through a link')
+            return
+        source = path.join(parent, linkname) if symlink else path.join(root, linkname)
+        if not inside(path.realpath(source)):
+            raise ValueError(f'link {name} -> {linkname} escapes the extraction folder')
+
     def folder_name(self, target: str, *exts: List[str]) -> str:
         filename = path.basename(target)
         for ext in exts:
@@ -209,6 +732,15 @@ class Extractor(ABC):
                 return filename[:-len(ext)]
         return filename + '.extracted'
     
+    @staticmethod
+    def detect(target: str) -> Optional[str]:
+        with open(target, 'rb') as ifile:
+            head = ifile.read(512)
+        for offset, magic, format in Extractor.MAGICS:
+            if head[offset:offset + len(magic)] == magic:
+                return format
+        return None
+
     @staticmethod
     def get(root: str, format: str) -> Optional['Extractor']:
         constructor = Extractor.REGISTERED_EXTRACTORS.get(format)
@@ -219,88 +751,260 @@ class Extractor(ABC):
 
 class TarExtractor(Extractor):
 
-    def __init__(self, root: str, format: Literal["gz","bz2","xz"], logger: Optional[Logger] = None) -> None:
+    EXTS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tar.xz', '.txz', '.tar.zst', '.tzst', '.tar')
+    streamable = True
+
+    def __init__(self, root: str, format: Literal["gz","bz2","xz","zst",""], logger: Optional[Logger] = None) -> None:
         super().__init__(root, logger)
+        self.compression = format
         self.format = f'r:{format}'
 
     def extract(self, target: str) -> Optional[str]:
+        return self._extract_staged(target, self.folder_name(target, *TarExtractor.EXTS), lambda: self._open_file(target))
+
+    def extract_stream(self, stream: RawIOBase, name: str, verify: Callable[[], bool]) -> Optional[str]:
+        return self._extract_staged(name, self.folder_name(name, *TarExtractor.EXTS), lambda: self._open_stream(stream), verify)
+
+    def _open_file(self, target: str):
         from tarfile import TarFile
-        try:
-            with TarFile.open(target, self.format) as tar:
-                folder = None
-                for member in tar:
-                    if member.isdir() and folder is None:
-                        folder = member.path
-                    else:
-                        if folder is None:
-                            break
-                        if not member.path.startswith(folder):
-                            folder = None
-                            break
-                if folder:
-                    output = path.join(self.root, folder)
-                    folder = self.root
-                else:
-                    folder_name = self.folder_name(target, '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tar.xz', '.txz')
-                    output = path.join(self.root, folder_name)
-                    folder = output
-                    self.logger.warning('Unwrapped tar file; wrap with folder %s', folder_name)
-                    try:
-                        mkdir(target)
-                    except FileExistsError:
-                        pass
-                self.logger.info('Extracting %s to %s', target, folder)
-                tar.extractall(folder)
-                self.logger.info('Extracted %s as %s', target, output)
-                return output
-        except Exception as e:
-            self.logger.error('Failed to extract %s: %s', target, e)
-            return None
+        return TarFile.open(target, self.format)
+
+    def _open_stream(self, stream: RawIOBase):
+        from tarfile import TarFile
+        return TarFile.open(fileobj=stream, mode=f'r|{self.compression}')
         
 Extractor.REGISTERED_EXTRACTORS['tgz'] = lambda root: TarExtractor(root, 'gz')
+Extractor.REGISTERED_EXTRACTORS['tbz'] = lambda root: TarExtractor(root, 'bz2')
+Extractor.REGISTERED_EXTRACTORS['txz'] = lambda root: TarExtractor(root, 'xz')
+Extractor.REGISTERED_EXTRACTORS['tar'] = lambda root: TarExtractor(root, '')
+
+
+class ZstdTarExtractor(TarExtractor):
+
+    def __init__(self, root: str, logger: Optional[Logger] = None) -> None:
+        super().__init__(root, 'zst', logger)
+
+    def _open_file(self, target: str):
+        return self._open_zstd(target, None)
+
+    def _open_stream(self, stream: RawIOBase):
+        return self._open_zstd(None, stream)
+
+    @contextmanager
+    def _open_zstd(self, target: Optional[str], stream: Optional[RawIOBase]) -> Iterator:
+        import tarfile
+        from contextlib import ExitStack
+        with ExitStack() as stack:
+            if 'zst' in tarfile.TarFile.OPEN_METH:
+                if stream is None:
+                    stream = stack.enter_context(open(target, 'rb'))
+                yield stack.enter_context(tarfile.open(fileobj=stream, mode='r|zst'))
+                return
+            try:
+                import zstandard
+            except ImportError:
+                zstandard = None
+            if zstandard:
+                if stream is None:
+                    stream = stack.enter_context(open(target, 'rb'))
+                reader = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(stream, closefd=False))
+                yield stack.enter_context(tarfile.open(fileobj=reader, mode='r|'))
+                return
+            yield from self._open_zstd_command(target, stream, stack)
+
+    def _open_zstd_command(self, target: Optional[str], stream: Optional[RawIOBase], stack) -> Iterator:
+        import tarfile
+        from shutil import copyfileobj, which
+        from subprocess import DEVNULL, PIPE, Popen
+        from threading import Thread
+        binary = which('zstd')
+        if not binary:
+            raise RuntimeError('zstd archives need Python 3.14+, the zstandard package or the zstd command')
+        self.logger.debug('Decompress zstd with %s', binary)
+        if stream is None:
+            proc = Popen([binary, '-dcq', target], stdin=DEVNULL, stdout=PIPE)
+            feeder = None
+        else:
+            proc = Popen([binary, '-dcq'], stdin=PIPE, stdout=PIPE)
+            errors = []
+            def feed() -> None:
+                try:
+                    copyfileobj(stream, proc.stdin, Downloader.FS_BUFFER_SIZE)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except OSError:
+                        pass
+            feeder = Thread(target=feed, name='zstd-feed', daemon=True)
+            feeder.start()
+        try:
+            yield stack.enter_context(tarfile.open(fileobj=proc.stdout, mode='r|'))
+            while proc.stdout.read(Downloader.FS_BUFFER_SIZE):
+                pass
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+            if feeder:
+                feeder.join()
+        if feeder and errors:
+            raise errors[0]
+        if returncode != 0:
+            raise RuntimeError(f'zstd exited with {returncode}')
+
+Extractor.REGISTERED_EXTRACTORS['tzst'] = lambda root: ZstdTarExtractor(root)
+
+
+class ByteBudget(object):
+
+    def __init__(self, limit: int) -> None:
+        from threading import Condition
+        self.limit = limit
+        self.used = 0
+        self.cond = Condition()
+
+    def acquire(self, size: int) -> None:
+        with self.cond:
+            while self.used and self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+
+class ParallelTarExtractor(TarExtractor):
+
+    MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, root: str, format: Literal["gz","bz2","xz"], workers: Optional[int] = None, logger: Optional[Logger] = None) -> None:
+        super().__init__(root, format, logger)
+        self.workers = workers
+
+    def _extract_into(self, tar, folder: str) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+        from os import chmod, link, symlink, utime
+        budget = ByteBudget(ParallelTarExtractor.MAX_PENDING_BYTES)
+        created = set()
+        directories = []
+        links = []
+        futures = []
+        def ensure_dir(dirpath: str) -> None:
+            if dirpath not in created:
+                makedirs(dirpath, exist_ok=True)
+                created.add(dirpath)
+        def write(target: str, data: bytes, mode: int, mtime: float) -> None:
+            try:
+                with open(target, 'wb') as ofile:
+                    ofile.write(data)
+                chmod(target, mode)
+                utime(target, (mtime, mtime))
+            finally:
+                budget.release(len(data))
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='extract') as executor:
+            for member in Extractor._safe_members(tar):
+                target = path.join(folder, member.name)
+                if member.isdir():
+                    ensure_dir(target)
+                    directories.append((target, member.mode, member.mtime))
+                elif member.isfile():
+                    ensure_dir(path.dirname(target))
+                    data = tar.extractfile(member).read()
+                    budget.acquire(len(data))
+                    futures.append(executor.submit(write, target, data, member.mode, member.mtime))
+                elif member.issym() or member.islnk():
+                    links.append(member)
+                else:
+                    self.logger.warning('Skip unsupported member %s of type %r', member.name, member.type)
+            for future in futures:
+                future.result()
+        for member in links:
+            Extractor.check_resolved(folder, member.name, member.linkname, member.issym())
+            target = path.join(folder, member.name)
+            ensure_dir(path.dirname(target))
+            if member.issym():
+                symlink(member.linkname, target)
+            else:
+                link(path.join(folder, member.linkname), target)
+        for target, mode, mtime in reversed(directories):
+            chmod(target, mode)
+            utime(target, (mtime, mtime))
+
+Extractor.REGISTERED_EXTRACTORS['tgz-parallel'] = lambda root: ParallelTarExtractor(root, 'gz')
+Extractor.REGISTERED_EXTRACTORS['tbz-parallel'] = lambda root: ParallelTarExtractor(root, 'bz2')
+Extractor.REGISTERED_EXTRACTORS['txz-parallel'] = lambda root: ParallelTarExtractor(root, 'xz')
         
 
 class ZipExtractor(Extractor):
 
     def extract(self, target: str) -> Optional[str]:
         from zipfile import ZipFile
-        try:
-            with ZipFile(target) as zip:
-                folder = None
-                for member in zip.infolist():
-                    if member.is_dir() and folder is None:
-                        folder = member.filename
-                    else:
-                        if folder is None:
-                            break
-                        if not member.filename.startswith(folder):
-                            folder = None
-                            break
-                if folder:
-                    if folder.endswith('/'):
-                        folder = folder[:-1]
-                    output = path.join(self.root, folder)
-                    folder = self.root
-                else:
-                    folder_name = self.folder_name(target, '.zip')
-                    output = path.join(self.root, folder_name)
-                    folder = output
-                    self.logger.warning('Unwrapped zip file; wrap with folder %s', folder_name)
-                    try:
-                        mkdir(target)
-                    except FileExistsError:
-                        pass
-                self.logger.info('Extracting %s to %s', target, folder)
-                zip.extractall(folder)
-                self.logger.info('Extracted %s as %s', target, output)
-                return output
-        except Exception as e:
-            self.logger.error('Failed to extract %s: %s', target, e)
-            return None
+        return self._extract_staged(target, self.folder_name(target, '.zip'), lambda: ZipFile(target))
         
 Extractor.REGISTERED_EXTRACTORS['zip'] = lambda root: ZipExtractor(root)
 
 
+def _extract_zip_members(archive: str, folder: str, names: List[str]) -> int:
+    from zipfile import ZipFile
+    with ZipFile(archive) as zip:
+        for name in names:
+            zip.extract(name, folder)
+    return len(names)
+
+
+class ParallelZipExtractor(ZipExtractor):
+
+    def __init__(self, root: str, workers: Optional[int] = None, logger: Optional[Logger] = None) -> None:
+        super().__init__(root, logger)
+        self.workers = workers
+
+    def _extract_into(self, zip, folder: str) -> None:
+        from concurrent.futures import ProcessPoolExecutor
+        from os import cpu_count
+        workers = self.workers or cpu_count() or 1
+        members = sorted(zip.infolist(), key=lambda info: info.compress_size, reverse=True)
+        for member in members:
+            if member.is_dir():
+                zip.extract(member, folder)
+        files = [member for member in members if not member.is_dir()]
+        if workers <= 1 or len(files) < workers * 2:
+            for member in files:
+                zip.extract(member, folder)
+            return
+        parts: List[List[str]] = [[] for _ in range(workers)]
+        loads = [0] * workers
+        for member in files:
+            i = loads.index(min(loads))
+            parts[i].append(member.filename)
+            loads[i] += member.compress_size + 4096
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_extract_zip_members, zip.filename, folder, names) for names in parts if names]
+            for future in futures:
+                future.result()
+
+Extractor.REGISTERED_EXTRACTORS['zip-parallel'] = lambda root: ParallelZipExtractor(root)
+
+
+class AutoExtractor(Extractor):
+
+    def extract(self, target: str) -> Optional[str]:
+        format = Extractor.detect(target)
+        extractor = Extractor.get(self.root, format) if format else None
+        if not extractor:
+            self.logger.error('Failed to extract %s: unknown archive format', target)
+            return None
+        self.logger.info('Detected %s as %s', target, format)
+        return extractor.extract(target)
+
+Extractor.REGISTERED_EXTRACTORS['auto'] = lambda root: AutoExtractor(root)
+
+
 
 ####################################################################################################
 ### Section Download Workflow
@@ -309,13 +1013,13 @@ Extractor.REGISTERED_EXTRACTORS['zip'] = lambda root: ZipExtractor(root)
 
 class SourceKit(object):
 
-    def __init__(self, vars: Variables, downloader: Downloader, logger: Optional[Logger] = None) -> None:
+    def __init__(self, vars: Variables, downloader: Downloader, streaming: bool = False, logger: Optional[Logger] = None) -> None:
         self.vars = vars
         self.downloader = downloader
+        self.streaming = streaming
         self.logger = logger or getLogger(self.__class__.__name__)
         self.field_final = 'build'
         self.field_download_cache = '_dlcache'
-        self.vars.sync()
 
     def download_and_extract(self, key: str, cfg: CfgItemDownload) -> Optional[str]:
         folder = self._read_build_info(key)
@@ -325,6 +1029,8 @@ class SourceKit(object):
         url, downloaded = self._read_cache_info(key)
         if url and downloaded and cfg.url == url and path.isfile(downloaded):
             self.logger.info('download_and_extract skip download %s: exist %s', key, downloaded)
+        elif self.streaming and (folder := self._stream_and_extract(key, cfg)):
+            return folder
         else:
             self.logger.info('download_and_extract download begin %s: %s', key, cfg.url)
             downloaded = self.downloader.download_and_validate(cfg)
@@ -346,6 +1052,45 @@ class SourceKit(object):
         self.logger.info('download_and_extract extract end %s: %s', key, folder)
         self.vars.sync()
         return folder
+
+    def _stream_and_extract(self, key: str, cfg: CfgItemDownload) -> Optional[str]:
+        extractor = Extractor.get(self.downloader.root, cfg.format)
+        if not extractor or not extractor.streamable:
+            return None
+        if self.downloader.in_store(cfg):
+            return None
+        self.logger.info('download_and_extract stream begin %s: %s', key, cfg.url)
+        try:
+            with self.downloader.stream(cfg) as stream:
+                folder = extractor.extract_stream(stream, stream.name, stream.verify)
+        except Exception as e:
+            self.logger.error('download_and_extract stream failed %s: %s', key, e)
+            folder = None
+        if not folder:
+            self.logger.warning('download_and_extract stream failed %s; fall back to download', key)
+            return None
+        self._write_build_info(key, folder)
+        self.logger.info('download_and_extract stream end %s: %s', key, folder)
+        self.vars.sync()
+        return folder
+
+    def download_and_extract_all(self, cfgs: Dict[str, CfgItemDownload], workers: int = 1) -> Dict[str, Optional[str]]:
+        if workers <= 1 or len(cfgs) <= 1:
+            return {key: self.download_and_extract(key, cfg) for key, cfg in cfgs.items()}
+        from concurrent.futures import ThreadPoolExecutor
+        results: Dict[str, Optional[str]] = {}
+        with ThreadPoolExecutor(max_workers=min(workers, len(cfgs)), thread_name_prefix='sourcekit') as executor:
+            futures = {key: executor.submit(self.download_and_extract, key, cfg) for key, cfg in cfgs.items()}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    self.logger.error('download_and_extract_all failed %s: %s', key, e)
+                    results[key] = None
+        failed = [key for key, folder in results.items() if not folder]
+        if failed:
+            self.logger.error('download_and_extract_all failed: %s', ', '.join(failed))
+        return results
         
     def _load_cache_record(self) -> None:
         try:
@@ -385,30 +1130,43 @@ class SourceKit(object):
 ####################################################################################################
 
 
-def main(cfg_file: str, vars_file: str, workspace: str = 'build', proxies: Optional[Dict[str, str]] = None):    
+def load_config(cfg_file: str) -> Dict[str, CfgItemDownload]:
     downloads_cfg: Dict[str, CfgItemDownload] = {}
     with open(cfg_file, 'r') as ifile:
         data = json_load(ifile)
         for key, item_raw in data.items():
             item = CfgItemDownload(**item_raw)
             downloads_cfg[key] = item
+    return downloads_cfg
+
+
+def main(cfg_file: str, vars_file: str, workspace: str = 'build', proxies: Optional[Dict[str, str]] = None, workers: int = 1, segments: int = 1, store: Optional[ArtifactStore] = None, streaming: bool = False):    
+    downloads_cfg = load_config(cfg_file)
     if downloads_cfg:
         vars_writer = Variables(vars_file)
-        downloader = Downloader(workspace, proxies=proxies)
-        kit = SourceKit(vars_writer, downloader)
-        for key, item in downloads_cfg.items():
-            kit.download_and_extract(key, item)
+        downloader = Downloader(workspace, proxies=proxies, segments=segments, store=store)
+        kit = SourceKit(vars_writer, downloader, streaming)
+        kit.download_and_extract_all(downloads_cfg, workers)
 
 
 if __name__ == '__main__':
     import logging
     import sys
-    from os import environ
-    logging.basicConfig(level=logging.DEBUG)
+    from argparse import ArgumentParser
+    from os import cpu_count, environ
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s')
     ROOT, _ = path.split(sys.argv[0])
     WORKSPACE = 'build'
     VARS_FILE = path.join(WORKSPACE, 'deploy.vars.json')
     CFG_FILE = path.join(ROOT, 'openresty-build-downloads.json')
+    parser = ArgumentParser(description='SourceKit')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='number of concurrent downloads', default=min(4, cpu_count() or 1))
+    parser.add_argument('-s', '--segments', dest='segments', type=int, help='number of connections per download when the server supports ranges', default=1)
+    parser.add_argument('--stream', dest='stream', action='store_true', help='extract archives while downloading without keeping them in the workspace')
+    parser.add_argument('--cache-dir', dest='cache_dir', help='shared artifact store directory', default=ArtifactStore.default_root())
+    parser.add_argument('--cache-size', dest='cache_size', type=int, help='artifact store size cap in MiB', default=ArtifactStore.DEFAULT_MAX_SIZE // (1024 * 1024))
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', help='do not use the shared artifact store')
+    args = parser.parse_args()
     proxies = {}
     proxy = environ.get('http_proxy')
     if not proxy:
@@ -421,5 +1179,6 @@ if __name__ == '__main__':
     if proxy:
         proxies['https'] = proxy
 
-    main(CFG_FILE, VARS_FILE, WORKSPACE, proxies)
+    store = None if args.no_cache else ArtifactStore(args.cache_dir, args.cache_size * 1024 * 1024)
+    main(CFG_FILE, VARS_FILE, WORKSPACE, proxies, args.jobs, args.segments, store, args.stream)
     
\ No newline at end of file
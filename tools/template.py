@@ -1,5 +1,8 @@
 from io import TextIOBase
-from typing import Dict, List, Optional, Union
+from os import path
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
 from .variables import Variables
 
 ####################################################################################################
@@ -8,77 +11,196 @@ from .variables import Variables
 
 class Template(object):
 
-    class Var(object):
-
-        def __init__(self, key: str, kind: int) -> None:
-            self.key = key
-            self.kind = kind
-
     PATTERN = r'{{\s*("?[a-zA-Z_][\w.-]*"?)\s*}}'
     PATTERN_RE = None
+    PARTIAL_PATTERN = r'{{\s*"?(?:[a-zA-Z_][\w.-]*)?"?\s*}?\Z'
+    PARTIAL_RE = None
+    STREAM_CHUNK_SIZE = 64 * 1024
+    MAX_PARTIAL = 4096
+    CACHE: Dict[str, Tuple[List[str], List[Tuple[int, str, int]], Dict[str, int]]] = {}
+    STAT_CACHE: Dict[str, Tuple[int, int, str]] = {}
+    CACHE_LOCK = Lock()
 
     def __init__(self, template_file: Optional[Union[TextIOBase, str]] = None, template: Optional[str] = None) -> None:
-        from re import compile as re_compile
-        if Template.PATTERN_RE is None:
-            Template.PATTERN_RE = re_compile(Template.PATTERN)
-        self.parts: List[Union[str, Template.Var]] = []
+        self.pieces: List[str] = []
+        self.slots: List[Tuple[int, str, int]] = []
         self.vars: Dict[str, int] = {}
         if template_file:
             if isinstance(template_file, str):
                 with open(template_file, 'r') as f:
-                    while line := f.readline():
-                        self._parse(line)
+                    self._parse(f.read())
             else:
-                while line := template_file.readline():
-                    self._parse(line)
+                self._parse(template_file.read())
         elif template:
             self._parse(template)
-        else:
+        elif template is None:
             raise ValueError('template_file or template must be specified')
 
     def _parse(self, chunk: str):
-        last = 0
-        for m in Template.PATTERN_RE.finditer(chunk):
-            key = m.group(1)
-            kind = 0
-            a = key.startswith('"')
-            b = key.endswith('"')
-            if a and b:
-                kind = 1
-                key = key[1:-1]
-            elif (not a) and (not b):
-                kind = 0
-            else:
-                raise ValueError(f'invalid key {key}')
-            i = m.start()
-            prefix = chunk[last:i]
+        tokens = Template._pattern().split(chunk)
+        pieces = self.pieces
+        for prefix, key in zip(tokens[0::2], tokens[1::2]):
+            key, kind = Template._key(key)
             if prefix:
-                self.parts.append(prefix)
-            self.parts.append(Template.Var(key, kind))
+                pieces.append(prefix)
+            self.slots.append((len(pieces), key, kind))
+            pieces.append('')
             self.vars[key] = self.vars.get(key, 0) + 1
-            last = m.end()
-        suffix = chunk[last:]
+        suffix = tokens[-1]
         if suffix:
-            self.parts.append(suffix)
+            pieces.append(suffix)
 
-    def render_into(self, variables: Variables, output: TextIOBase) -> bool:
+    @staticmethod
+    def _pattern():
+        from re import compile as re_compile
+        if Template.PATTERN_RE is None:
+            Template.PATTERN_RE = re_compile(Template.PATTERN)
+            Template.PARTIAL_RE = re_compile(Template.PARTIAL_PATTERN)
+        return Template.PATTERN_RE
+
+    @staticmethod
+    def _key(key: str) -> Tuple[str, int]:
+        a = key.startswith('"')
+        b = key.endswith('"')
+        if a and b:
+            return key[1:-1], 1
+        if (not a) and (not b):
+            return key, 0
+        raise ValueError(f'invalid key {key}')
+
+    def render(self, variables: Variables) -> Optional[str]:
         from shlex import quote
-        cache: Dict[str, str] = {}
+        values: Dict[str, str] = {}
         for var in self.vars.keys():
             value = variables[var]
             if value is None:
-                return False
-            cache[var] = str(value)
-        for part in self.parts:
-            if isinstance(part, str):
-                output.write(part)
-            else:
-                value = cache[part.key]
-                if part.kind == 1:
-                    value = quote(value)
-                output.write(value)
+                return None
+            values[var] = str(value)
+        pieces = self.pieces.copy()
+        for i, key, kind in self.slots:
+            pieces[i] = quote(values[key]) if kind == 1 else values[key]
+        return ''.join(pieces)
+
+    def render_into(self, variables: Variables, output: TextIOBase) -> bool:
+        rendered = self.render(variables)
+        if rendered is None:
+            return False
+        output.write(rendered)
         output.flush()
         return True
+
+    @staticmethod
+    def tokens(input: TextIOBase, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple[str, Optional[str], int]]:
+        pattern = Template._pattern()
+        pending = ''
+        while True:
+            chunk = input.read(chunk_size)
+            buffer = pending + chunk if pending else chunk
+            end = 0
+            for m in pattern.finditer(buffer):
+                key, kind = Template._key(m.group(1))
+                yield buffer[end:m.start()], key, kind
+                end = m.end()
+            if not chunk:
+                if end < len(buffer):
+                    yield buffer[end:], None, 0
+                return
+            keep = Template._partial_start(buffer, end)
+            if keep > end:
+                yield buffer[end:keep], None, 0
+            pending = buffer[keep:]
+
+    @staticmethod
+    def _partial_start(buffer: str, end: int) -> int:
+        start = buffer.rfind('{{', end)
+        if start >= 0 and len(buffer) - start <= Template.MAX_PARTIAL and Template.PARTIAL_RE.match(buffer, start):
+            return start
+        if buffer.endswith('{', end):
+            return len(buffer) - 1
+        return len(buffer)
+
+    @staticmethod
+    def scan(input: TextIOBase, chunk_size: int = STREAM_CHUNK_SIZE) -> Dict[str, int]:
+        vars: Dict[str, int] = {}
+        for _, key, _ in Template.tokens(input, chunk_size):
+            if key is not None:
+                vars[key] = vars.get(key, 0) + 1
+        return vars
+
+    @staticmethod
+    def render_stream(input: TextIOBase, variables: Variables, output: TextIOBase, chunk_size: int = STREAM_CHUNK_SIZE) -> bool:
+        from shlex import quote
+        values: Dict[Tuple[str, int], str] = {}
+        for text, key, kind in Template.tokens(input, chunk_size):
+            if text:
+                output.write(text)
+            if key is None:
+                continue
+            value = values.get((key, kind))
+            if value is None:
+                raw = variables[key]
+                if raw is None:
+                    return False
+                value = quote(str(raw)) if kind == 1 else str(raw)
+                values[(key, kind)] = value
+            output.write(value)
+        output.flush()
+        return True
+
+    @staticmethod
+    def compile(template_file: str, cache_dir: Optional[str] = None) -> 'Template':
+        import hashlib
+        from os import stat
+        st = stat(template_file)
+        key = path.abspath(template_file)
+        with Template.CACHE_LOCK:
+            known = Template.STAT_CACHE.get(key)
+            if known and known[0] == st.st_size and known[1] == st.st_mtime_ns and known[2] in Template.CACHE:
+                return Template._from_compiled(Template.CACHE[known[2]])
+        with open(template_file, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        with Template.CACHE_LOCK:
+            compiled = Template.CACHE.get(digest)
+        if compiled is None and cache_dir:
+            compiled = Template._load_compiled(cache_dir, digest)
+        if compiled is None:
+            template = Template(template=data.decode())
+            compiled = (template.pieces, template.slots, template.vars)
+            if cache_dir:
+                Template._save_compiled(cache_dir, digest, compiled)
+        with Template.CACHE_LOCK:
+            Template.CACHE[digest] = compiled
+            Template.STAT_CACHE[key] = (st.st_size, st.st_mtime_ns, digest)
+        return Template._from_compiled(compiled)
+
+    @staticmethod
+    def _from_compiled(compiled: Tuple[List[str], List[Tuple[int, str, int]], Dict[str, int]]) -> 'Template':
+        template = Template(template='')
+        template.pieces, template.slots, template.vars = compiled
+        return template
+
+    @staticmethod
+    def _load_compiled(cache_dir: str, digest: str) -> Optional[Tuple[List[str], List[Tuple[int, str, int]], Dict[str, int]]]:
+        from json import load as json_load
+        try:
+            with open(path.join(cache_dir, f'{digest}.json'), 'r') as f:
+                data = json_load(f)
+            return data['pieces'], [tuple(slot) for slot in data['slots']], data['vars']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _save_compiled(cache_dir: str, digest: str, compiled: Tuple[List[str], List[Tuple[int, str, int]], Dict[str, int]]) -> None:
+        from json import dumps as json_dumps
+        from os import makedirs
+        from .fileops import atomic_write
+        pieces, slots, vars = compiled
+        try:
+            makedirs(cache_dir, exist_ok=True)
+            atomic_write(path.join(cache_dir, f'{digest}.json'), json_dumps({'pieces': pieces, 'slots': slots, 'vars': vars}))
+        except OSError:
+            pass
     
 
 ####################################################################################################
@@ -88,7 +210,6 @@ class Template(object):
 if __name__ == '__main__':
     from argparse import ArgumentParser
     import sys
-    from os import path
     
     ROOT, _ = path.split(sys.argv[0])
     WORKSPACE = 'build'
@@ -100,6 +221,7 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', dest='output', help='output file', default='@build.openresty')
     parser.add_argument('-v', '--variables-file', dest='vars_file', help='variables file', default=VARS_FILE)
     parser.add_argument('-V', '--variable', dest='vars', help='variable like \"key=value\"', nargs='*')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', help='render in bounded chunks without loading the whole template')
     args = parser.parse_args()
     sys_vars = {}
     if args.vars:
@@ -107,7 +229,9 @@ if __name__ == '__main__':
             key, value = var.split('=', 1)
             sys_vars[key] = value
     variables = Variables(args.vars_file, sys_vars)
-    variables.sync()
+    if variables['build.jobs'] is None:
+        from os import cpu_count
+        variables.sys['build.jobs'] = str(cpu_count() or 1)
     input_file = args.input
     output_file = args.output
     if output_file.startswith('@'):
@@ -115,8 +239,13 @@ if __name__ == '__main__':
         output_dir = variables[key]
         output_file = path.join(output_dir, OUTPUT_FILE)
     print(input_file, '==>', output_file)
-    template = Template(input_file)
-    for key in template.vars.keys():
+    if args.stream:
+        with open(input_file, 'r') as ifile:
+            keys = Template.scan(ifile)
+    else:
+        template = Template(input_file)
+        keys = template.vars
+    for key in keys.keys():
         value = variables[key]
         if value is None:
             value = input(f'please input value for {key}: ')
@@ -124,4 +253,8 @@ if __name__ == '__main__':
                 variables[key] = value
     variables.sync()
     with open(output_file, 'w') as output:
-        template.render_into(variables, output)
\ No newline at end of file
+        if args.stream:
+            with open(input_file, 'r') as ifile:
+                Template.render_stream(ifile, variables, output)
+        else:
+            template.render_into(variables, output)
\ No newline at end of file
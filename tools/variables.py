@@ -1,5 +1,10 @@
-from typing import Dict, Optional, Set, Union
-from json import load as json_load, dump as json_dump
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Union
+from json import load as json_load, dumps as json_dumps
+from os import makedirs, path as os_path
+from threading import RLock
+
+from .fileops import _WINDOWS, atomic_write
 
 ####################################################################################################
 ### Section Variables
@@ -7,52 +12,113 @@ from json import load as json_load, dump as json_dump
 
 class Variables(object):
 
+    LOCK_SUFFIX = '.lock'
+
     def __init__(self, path: str, sys: Optional[Dict[str, Union[str, int, float, bool]]] = None):
         self.path = path
         self.sys = sys or {}
-        self.data = {}
-        self.modified: Set[str] = set()
+        self.data: Optional[Dict] = None
+        self.flat: Optional[Dict[str, Union[str, int, float, bool, Dict]]] = None
+        self.deltas: Dict[str, Union[str, int, float, bool, None]] = {}
         self.pattern = None
+        self.lock = RLock()
 
-    def sync(self):
-        try:
-            data = None
-            with open(self.path, 'r') as f:
-                data = json_load(f)
-        except FileNotFoundError:
-            data = {}
-        for key in self.modified:
-            new_value = Variables.plain_get(self.data, key)
-            Variables.plain_set(data, key, new_value)
+    def sync(self, fsync: bool = False):
+        with self.lock, self._file_lock():
+            self._sync(fsync)
+
+    def update(self, values: Dict[str, Union[str, int, float, bool]], fsync: bool = False):
+        with self.lock, self._file_lock():
+            for key, value in values.items():
+                self[key] = value
+            self._sync(fsync)
+
+    def _sync(self, fsync: bool = False):
+        data = self._read()
+        if not self.deltas:
+            self.data = data
+            self.flat = None
+            return
+        for key, value in self.deltas.items():
+            Variables.plain_set(data, key, value)
         try:
-            with open(self.path, 'w') as f:
-                json_dump(data, f, indent=4)
+            atomic_write(self.path, json_dumps(data, indent=4), fsync)
         finally:
-            self.modified.clear()
+            self.deltas.clear()
             self.data = data
+            self.flat = None
+
+    def _read(self) -> Dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json_load(f)
+        except FileNotFoundError:
+            return {}
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        if _WINDOWS:
+            yield
+            return
+        from fcntl import flock, LOCK_EX, LOCK_UN
+        folder = os_path.dirname(self.path)
+        if folder:
+            makedirs(folder, exist_ok=True)
+        with open(self.path + Variables.LOCK_SUFFIX, 'a') as lock_file:
+            flock(lock_file.fileno(), LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(lock_file.fileno(), LOCK_UN)
+
+    def _index(self) -> Dict[str, Union[str, int, float, bool, Dict]]:
+        if self.flat is None:
+            if self.data is None:
+                self.data = self._read()
+            self.flat = {}
+            Variables.flatten(self.data, '', self.flat)
+        return self.flat
 
     def __getitem__(self, key: str) -> Optional[Union[str, int, float, bool]]:
-        if key in self.sys:
-            return self.sys[key]
-        return Variables.plain_get(self.data, key)
+        with self.lock:
+            if key in self.sys:
+                return self.sys[key]
+            return self._index().get(key)
     
     def __setitem__(self, key: str, value: Union[str, int, float, bool]):
-        if key in self.sys:
-            self.sys[key] = value
-            return
-        Variables.plain_set(self.data, key, value)
-        self.modified.add(key)
+        with self.lock:
+            if key in self.sys:
+                self.sys[key] = value
+                return
+            flat = self._index()
+            old = flat.get(key)
+            Variables.plain_set(self.data, key, value)
+            self.deltas.pop(key, None)
+            self.deltas[key] = value
+            parent, _, _ = key.rpartition('.')
+            if isinstance(old, dict) or isinstance(value, dict) or (parent and not isinstance(flat.get(parent), dict)):
+                self.flat = None
+            else:
+                flat[key] = value
 
     def __repr__(self) -> str:
         return f'<Variables path={self.path} sys={self.sys} data={self.data}>'
 
+    @staticmethod
+    def flatten(data: Dict, prefix: str, flat: Dict[str, Union[str, int, float, bool, Dict]]) -> None:
+        for part, value in data.items():
+            key = prefix + part
+            flat[key] = value
+            if isinstance(value, dict):
+                Variables.flatten(value, key + '.', flat)
+
     @staticmethod
     def plain_set(data: Dict, key: str, value: Union[str, int, float, bool]) -> None:
         keys = key.split('.')
         p = data
         for part in keys[:-1]:
             next_p = p.get(part)
-            if next_p is None:
+            if not isinstance(next_p, dict):
                 next_p = {}
                 p[part] = next_p
             p = next_p
@@ -64,6 +130,8 @@ class Variables(object):
         keys = key.split('.')
         p = data
         for part in keys:
+            if not isinstance(p, dict):
+                return None
             p = p.get(part)
             if p is None:
                 return None